@@ -0,0 +1,200 @@
+import datetime
+import io
+import json
+import os
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.images import ImageFile
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from PIL import Image as PILImage
+
+from wagtail.core.models import Page, Site
+from wagtail.images.models import Image
+
+from .blocks import highlight_cache
+from .caches import BlogIndexCache
+from .models import BlogIndex, BlogPost, HeroImage, post_fragments
+
+
+SITE_HOSTNAME = 'localhost'
+
+
+def generate_site(num_posts, num_tags, num_images=4, seed=0):
+    """
+    Replaces the site in the current database with a synthetic one: a single
+    BlogIndex with the given number of published posts spread across ten
+    years, with text, code, math, image_row and full_bleed_image blocks and a
+    mix of hero images. The output is deterministic for a given seed.
+    """
+
+    rng = random.Random(seed)
+
+    with transaction.atomic():
+        for page in Page.objects.filter(depth=2):
+            page.delete()
+        root = Page.objects.get(depth=1)
+
+        images = [create_image('Image {}'.format(i), (1600 + 100 * i, 900)) for i in range(num_images)]
+        heroes = [
+            HeroImage.objects.create(name='Light hero', wagtail_image=images[0], add_parallax=True,
+                                     text_color='light'),
+            HeroImage.objects.create(name='Dark mode hero', wagtail_image=images[-1],
+                                     wagtail_image_dark=images[0], add_parallax=False, text_color='either'),
+        ]
+
+        index = root.add_child(instance=BlogIndex(title='Blog', slug='blog', hero_image=heroes[0]))
+        Site.objects.all().delete()
+        Site.objects.create(hostname=SITE_HOSTNAME, root_page=index, is_default_site=True)
+
+        tags = ['tag-{}'.format(i) for i in range(num_tags)]
+        start = timezone.make_aware(datetime.datetime(2010, 1, 1))
+        interval = datetime.timedelta(days=3650) / max(num_posts, 1)
+
+        for i in range(num_posts):
+            pub_date = start + i * interval
+            post = BlogPost(title='Post {}'.format(i), slug='post-{}'.format(i), pub_date=pub_date,
+                            body=json.dumps(generate_body(rng, i, images)),
+                            hero_image=rng.choice(heroes + [None]),
+                            live=True, first_published_at=pub_date, last_published_at=pub_date)
+            post.tags.add(*rng.sample(tags, min(len(tags), rng.randint(1, 3))))
+            index.add_child(instance=post)
+
+            # Equivalent to publishing the revision, without publish()'s per-page bookkeeping
+            revision = post.save_revision()
+            BlogPost.objects.filter(id=post.id).update(live_revision=revision, has_unpublished_changes=False)
+
+    BlogIndexCache.invalidate()
+    return index
+
+
+def generate_body(rng, i, images):
+    paragraph = '<p>Post {} has some text{}.</p>'.format(i, r' and math \(a^2 + b^2 = c^2\)' if i % 3 == 0 else '')
+    if i % 5 == 0:
+        return [{'type': 'text', 'value': paragraph}]
+
+    body = [
+        {'type': 'text', 'value': paragraph},
+        {'type': 'code', 'value': {'code': 'def post_{0}():\n    return {0}\n'.format(i),
+                                   'language': rng.choice(['python', 'javascript', 'rust', ''])}},
+        {'type': 'math', 'value': r'\sum_{{k=1}}^{{{}}} k'.format(i)},
+        {'type': 'image_row', 'value': {'images': [{'image': image.id, 'weight': rng.randint(1, 3)}
+                                                   for image in rng.sample(images, min(len(images), 2))],
+                                        'caption': 'Images for post {}'.format(i)}},
+        {'type': 'full_bleed_image', 'value': {'image': rng.choice(images).id, 'caption': '',
+                                               'add_parallax': i % 2 == 0}},
+        {'type': 'text', 'value': '<p>More text.</p>' * rng.randint(1, 10)},
+    ]
+    rng.shuffle(body)
+    return body
+
+
+def create_image(title, size):
+    data = io.BytesIO()
+    PILImage.new('RGB', size, (size[0] % 256, 128, 64)).save(data, 'JPEG')
+    return Image.objects.create(title=title, file=ImageFile(data, name='{}.jpg'.format(title.lower()
+                                                                                       .replace(' ', '_'))))
+
+
+def get_benchmark_urls(index, num_samples=3):
+    """
+    Returns (view name, URL) pairs for a sample of posts, every kind of
+    BlogIndex route and the feed.
+    """
+
+    urls = []
+
+    posts = list(index.public_posts().order_by('pub_date', 'id'))
+    if posts:
+        sample = sorted({round(i * (len(posts) - 1) / max(num_samples - 1, 1)) for i in range(num_samples)})
+        urls.extend(('blog_post', posts[i].url) for i in sample)
+
+    counts = index.archive_counts()
+    view_kwargs = [('all_posts', {}), ('all_posts', {'page_num': max(2, (counts.total - 1) //
+                                                                      index.posts_per_pagination_page + 1)})]
+    if counts.tags:
+        tag, count = counts.tags.most_common(1)[0]
+        view_kwargs.append(('posts_by_tag', {'tag': counts.tag_slugs[tag]}))
+    if counts.months:
+        year, month = max(counts.months)
+        view_kwargs.append(('posts_by_date', {'year': year}))
+        view_kwargs.append(('posts_by_date', {'year': year, 'month': month}))
+    view_kwargs.append(('feed', {}))
+
+    urls.extend((view_name, index.url + index.reverse_subpage(view_name, kwargs=kwargs))
+                for view_name, kwargs in view_kwargs)
+    return urls
+
+
+def measure_url(client, url, repeat):
+    """
+    Requests the given URL once with cold caches and then the given number
+    of times more, returning its status, query counts and latencies.
+    """
+
+    clear_caches()
+
+    timings = []
+    queries = []
+    status = None
+    for _ in range(repeat + 1):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            status = client.get(url).status_code
+            timings.append(time.perf_counter() - start)
+        queries.append(len(context.captured_queries))
+
+    return {
+        'status': status,
+        'cold_ms': timings[0] * 1000,
+        'cold_queries': queries[0],
+        'median_ms': statistics.median(timings[1:]) * 1000 if repeat else None,
+        'min_ms': min(timings[1:]) * 1000 if repeat else None,
+        'queries': queries[-1],
+    }
+
+
+def measure_views(index, repeat=5, num_samples=3):
+    client = Client(SERVER_NAME=SITE_HOSTNAME)
+    return [dict(view=view_name, url=url, **measure_url(client, url, repeat))
+            for view_name, url in get_benchmark_urls(index, num_samples)]
+
+
+def get_cache_settings(cache_dir):
+    """
+    Returns a copy of settings.CACHES with every cache moved to the
+    benchmark's own location: file-based ones under cache_dir and the rest
+    in memory under separate names. That way clear_caches() leaves the
+    site's caches alone, including the invalidation tokens shared with its
+    other processes.
+    """
+
+    cache_settings = {}
+    for alias, config in settings.CACHES.items():
+        if config['BACKEND'] == 'django.core.cache.backends.filebased.FileBasedCache':
+            config = dict(config, LOCATION=os.path.join(cache_dir, alias))
+        else:
+            config = dict(config, BACKEND='django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='benchmark-' + alias)
+        cache_settings[alias] = config
+    return cache_settings
+
+
+def clear_caches():
+    """
+    Empties every cache that views and builds use, so that measurements
+    start cold. This includes every Django cache, so it must only be called
+    with the settings from get_cache_settings().
+    """
+
+    for alias in settings.CACHES:
+        caches[alias].clear()
+    highlight_cache.clear()
+    post_fragments.clear()
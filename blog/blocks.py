@@ -1,32 +1,93 @@
+import functools
+import json
+import os
 import re
 
+import pygments
 from pygments import highlight
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers import get_all_lexers, get_lexer_by_name
 
-from wagtail.core.blocks import (BooleanBlock, CharBlock, ChoiceBlock, IntegerBlock, ListBlock, RichTextBlock,
-                                 StructBlock, TextBlock)
+from django.utils.safestring import mark_safe
+
+from wagtail.core.blocks import (BooleanBlock, CharBlock, ChoiceBlock, IntegerBlock, ListBlock, PageChooserBlock,
+                                 RichTextBlock, StructBlock, TextBlock)
 from wagtail.core.blocks.stream_block import StreamBlock
 from wagtail.documents.blocks import DocumentChooserBlock
 from wagtail.embeds.blocks import EmbedBlock
 from wagtail.images.blocks import ImageChooserBlock
 
+from .caches import BlockRenderCache, HighlightCache
+
+
+highlight_cache = HighlightCache()
+block_render_cache = BlockRenderCache()
+
+LEXER_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'lexer_table.json')
+
+# Links and embeds in rich text, which refer to pages, documents and images by ID
+RICH_TEXT_REFERENCE_RE = re.compile(r'<(?:a|embed)\b[^>]*>')
+ATTRIBUTE_RE = re.compile(r'([\w-]+)="([^"]*)"')
+RICH_TEXT_REFERENCE_TYPES = {('linktype', 'page'): 'pages', ('linktype', 'document'): 'documents',
+                             ('embedtype', 'image'): 'images'}
+
+
+def get_lexer_choices():
+    """
+    Returns the language choices for code blocks. This is passed to the
+    ChoiceBlock as a callable so that the list is only needed when an editor
+    form is shown, not whenever this module is imported.
+    """
+    return [(name, name) for name in load_lexer_table()['languages']]
+
+
+@functools.lru_cache(maxsize=None)
+def load_lexer_table():
+    """
+    Loads the table of lexer names generated by the update_lexer_table
+    command, since scanning every Pygments lexer is slow. If the table was
+    generated with a different Pygments version, scans the lexers instead.
+    """
+    try:
+        with open(LEXER_TABLE_PATH) as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        table = None
+
+    if table is None or table['pygments_version'] != pygments.__version__:
+        table = build_lexer_table()
+
+    return table
+
+
+def build_lexer_table():
+    return {
+        'pygments_version': pygments.__version__,
+        'languages': sorted(lexer[1][0] for lexer in get_all_lexers()),
+    }
+
 
 class CodeBlock(StructBlock):
     code = TextBlock()
-    language = ChoiceBlock(choices=[(name, name) for name in sorted(lexer[1][0] for lexer in get_all_lexers())],
-                           required=False)
+    language = ChoiceBlock(choices=get_lexer_choices, required=False)
+
+    formatter_options = {'lineseparator': '<br/>', 'nowrap': True, 'nobackground': True}
 
     def get_context(self, value, parent_context=None):
         context = super().get_context(value, parent_context=parent_context)
 
         if value['language']:
-            lexer = get_lexer_by_name(value['language'])
-            formatter = HtmlFormatter(lineseparator='<br/>', nowrap=True, nobackground=True)
-            context['highlighted_code'] = highlight(value['code'], lexer, formatter)
+            context['highlighted_code'] = highlight_cache.get(
+                value['code'], value['language'], self.formatter_options,
+                lambda: self.highlight(value['code'], value['language']))
 
         return context
 
+    def highlight(self, code, language):
+        lexer = get_lexer_by_name(language)
+        formatter = HtmlFormatter(**self.formatter_options)
+        return highlight(code, lexer, formatter)
+
     class Meta:
         icon = 'code'
         template = 'blog/blocks/code.html'
@@ -73,6 +134,9 @@ class ImageRowBlock(StructBlock):
     class Meta:
         icon = 'image'
         template = 'blog/blocks/image_row.html'
+        # Renditions used by the template, generated ahead of builds (see blog.renditions)
+        rendition_filters = ['original', 'min-612x280', 'min-1224x560', 'min-1836x840', 'min-612x280|format-webp',
+                             'min-1224x560|format-webp', 'min-1836x840|format-webp']
 
 
 class FullBleedImageBlock(StructBlock):
@@ -83,6 +147,8 @@ class FullBleedImageBlock(StructBlock):
     class Meta:
         icon = 'image'
         template = 'blog/blocks/full_bleed_image.html'
+        rendition_filters = ['original', 'width-960', 'width-1920', 'width-2880', 'width-960|format-webp',
+                             'width-1920|format-webp', 'width-2880|format-webp']
 
 
 class ContentBlock(StreamBlock):
@@ -96,6 +162,72 @@ class ContentBlock(StreamBlock):
     embed = EmbedBlock()
     document = DocumentChooserBlock()
 
+    @staticmethod
+    def references_content(block, raw_value):
+        """
+        Returns whether the output of a child block depends on content besides
+        its own value, like the pages it links to or the images it shows.
+        """
+
+        if isinstance(block, RichTextBlock):
+            return 'linktype=' in raw_value or 'embedtype=' in raw_value
+        return not isinstance(block, (CodeBlock, MathBlock))
+
+    def render_children(self, stream, context=None):
+        """
+        Renders each child of the given stream as include_block would, going
+        through the block render cache with their raw values so that cached
+        children are never converted to Python values.
+        """
+
+        rendered = []
+        for i, child in enumerate(stream.raw_data):
+            block = self.child_blocks[child['type']]
+            rendered.append(block_render_cache.get(block, child['value'],
+                                                   self.references_content(block, child['value']),
+                                                   lambda: stream[i].render_as_block(context=context)))
+        return mark_safe(''.join(rendered))
+
+
+def get_references(block, raw_value, references=None):
+    """
+    Returns the IDs of the pages, documents and images that the output of a
+    block depends on, found by walking its raw value, as sets under the
+    keys 'pages', 'documents' and 'images'.
+    """
+
+    if references is None:
+        references = {'pages': set(), 'documents': set(), 'images': set()}
+    if raw_value is None:
+        return references
+
+    if isinstance(block, RichTextBlock):
+        for tag in RICH_TEXT_REFERENCE_RE.findall(raw_value):
+            attributes = dict(ATTRIBUTE_RE.findall(tag))
+            for (attribute, value), kind in RICH_TEXT_REFERENCE_TYPES.items():
+                if attributes.get(attribute) == value and attributes.get('id', '').isdigit():
+                    references[kind].add(int(attributes['id']))
+    elif isinstance(block, PageChooserBlock):
+        references['pages'].add(raw_value)
+    elif isinstance(block, DocumentChooserBlock):
+        references['documents'].add(raw_value)
+    elif isinstance(block, ImageChooserBlock):
+        references['images'].add(raw_value)
+    elif isinstance(block, StreamBlock):
+        for child in raw_value:
+            if child['type'] in block.child_blocks:
+                get_references(block.child_blocks[child['type']], child['value'], references)
+    elif isinstance(block, StructBlock):
+        for name, child_block in block.child_blocks.items():
+            get_references(child_block, raw_value.get(name), references)
+    elif isinstance(block, ListBlock):
+        for item in raw_value:
+            # Items are saved with IDs since Wagtail 2.16, and as bare values before
+            if isinstance(item, dict) and item.get('type') == 'item' and 'value' in item:
+                item = item['value']
+            get_references(block.child_block, item, references)
+    return references
+
 
 class ContentMethodsMixin(object):
     content_field_name = 'body'
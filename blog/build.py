@@ -0,0 +1,530 @@
+import contextlib
+import fcntl
+import filecmp
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import time
+from collections import Counter, defaultdict
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import connections
+from django.template import engines
+from django.urls import get_callable
+from django.utils.timezone import localtime
+
+from .compression import compress_output, get_compressor, set_compressor, take_worker_paths
+from .critical_css import get_critical_css, set_critical_css
+from .minify import get_minifier, set_minifier, take_worker_counts
+from .report import BuildReport, begin_output, end_output, get_report, set_report, take_records
+from .writer import get_writer
+
+
+logger = logging.getLogger(__name__)
+
+# The view instance used by each worker process, created by the pool initializer
+_worker_view = None
+
+# The manifest of the build in progress, if any
+_manifest = None
+
+STATIC_TAG_RE = re.compile(r'''{%\s*static\s+['"]([^'"]+)['"]''')
+
+
+class ParallelBuildMixin(object):
+    """
+    Mixin for bakery views that splits their work into independent tasks,
+    which are either built one by one or spread across a pool of worker
+    processes if settings.BUILD_WORKERS is greater than one.
+
+    Subclasses implement get_build_tasks() and build_task(). Tasks are sent
+    to other processes, so they must be picklable (e.g. page IDs rather than
+    page instances). Both modes run build_task() on the same tasks, so the
+    output doesn't depend on the number of workers.
+    """
+
+    @property
+    def build_method(self):
+        return self.build_tasks
+
+    def get_build_tasks(self):
+        raise NotImplementedError
+
+    def build_task(self, task):
+        raise NotImplementedError
+
+    def get_task_dependencies(self, task, state):
+        """
+        Returns the path of the file built by the given task and the content
+        it depends on, as recorded in the build manifest.
+        """
+        raise NotImplementedError
+
+    def build_tasks(self, tasks=None, workers=None):
+        """
+        Builds the given tasks, or all of them by default.
+        """
+
+        tasks = list(self.get_build_tasks() if tasks is None else tasks)
+
+        manifest = get_manifest()
+        if manifest is not None:
+            total = len(tasks)
+            needed = []
+            for task in tasks:
+                path, dependencies = self.get_task_dependencies(task, manifest.state)
+                if manifest.needs_build(self, path, dependencies):
+                    needed.append((task, path))
+            tasks = [task for task, path in needed]
+            logger.info('%s: %d of %d files up to date', get_view_path(type(self)), total - len(tasks), total)
+
+            # Create all the directories up front, before any worker processes are forked
+            if get_writer() is not None:
+                get_writer().make_dirs(path for task, path in needed)
+
+        run_build_tasks(type(self), tasks, view=self, workers=workers)
+
+
+def run_build_tasks(view_class, tasks, view=None, workers=None):
+    if workers is None:
+        workers = settings.BUILD_WORKERS
+    if not tasks:
+        return
+
+    workers = max(1, min(workers, len(tasks)))
+    view_path = get_view_path(view_class)
+    start = time.perf_counter()
+
+    if workers == 1:
+        view = view or view_class()
+        results = [_timed_build_task(view, task) for task in tasks]
+    else:
+        # Forked workers mustn't share the parent's database connections
+        connections.close_all()
+        chunksize = max(1, len(tasks) // (workers * 4))
+        results = []
+        with multiprocessing.Pool(workers, _init_worker, (view_path, settings.BUILD_DIR, get_worker_state())) as pool:
+            for result in pool.imap_unordered(_run_worker_task, tasks, chunksize):
+                pid, task_time, paths, records, minified, cache_counts = result
+                results.append((pid, task_time))
+                # Compress the worker's output here while it moves on to its next task
+                for path in paths:
+                    compress_output(path)
+                if get_report() is not None:
+                    get_report().add(records)
+                if get_minifier() is not None:
+                    get_minifier().add(minified)
+                add_cache_counts(cache_counts)
+
+    report_throughput(view_path, results, time.perf_counter() - start)
+
+
+def report_throughput(view_path, results, elapsed):
+    per_worker = defaultdict(lambda: [0, 0.0])
+    for pid, task_time in results:
+        per_worker[pid][0] += 1
+        per_worker[pid][1] += task_time
+
+    logger.info('%s: built %d tasks in %.2fs using %d worker(s)', view_path, len(results), elapsed, len(per_worker))
+    for pid, (count, busy) in sorted(per_worker.items()):
+        logger.info('  worker %d: %d tasks in %.2fs (%.1f tasks/s)', pid, count, busy, count / busy if busy else 0)
+
+
+def get_worker_state():
+    """
+    Returns the state of the build in progress that worker processes need,
+    pickled. Forked workers inherit it anyway, but those started with
+    "spawn" begin with a fresh interpreter, so it's passed to the pool
+    initializer. It includes model instances, which can only be unpickled
+    once Django is set up, hence the pickling here rather than by the pool.
+    """
+
+    from .models import get_hero_images
+
+    return pickle.dumps({
+        'compressor': get_compressor(),
+        'critical_css': get_critical_css(),
+        'minifier': get_minifier(),
+        'report': get_report() is not None,
+        'hero_images': get_hero_images(),
+    })
+
+
+def _init_worker(view_path, build_dir, state):
+    global _worker_view
+
+    # Processes started with "spawn" rather than "fork" begin with a fresh interpreter
+    if not apps.ready:
+        django.setup()
+    settings.BUILD_DIR = build_dir
+
+    from .models import set_hero_images
+
+    state = pickle.loads(state)
+    set_compressor(state['compressor'])
+    set_critical_css(state['critical_css'])
+    set_minifier(state['minifier'])
+    set_hero_images(state['hero_images'])
+    # Workers only measure their files, which the parent adds to its own report. Forked workers start with a copy
+    # of the parent's records, which mustn't be sent back to it.
+    if state['report'] and get_report() is None:
+        set_report(BuildReport())
+    take_records()
+    take_worker_paths()
+    take_worker_counts()
+    take_cache_counts()
+
+    _worker_view = get_callable(view_path)()
+
+
+def _run_worker_task(task):
+    return _timed_build_task(_worker_view, task) + (take_worker_paths(), take_records(), take_worker_counts(),
+                                                    take_cache_counts())
+
+
+def get_render_caches():
+    from .blocks import highlight_cache
+    from .models import post_fragments
+
+    return {'highlight': highlight_cache, 'post_fragments': post_fragments}
+
+
+def take_cache_counts():
+    """
+    Returns and resets the hit and miss counts of this process's render
+    caches, so that a worker process can send them to the parent.
+    """
+
+    counts = {}
+    for name, render_cache in get_render_caches().items():
+        counts[name] = Counter(render_cache.counts)
+        render_cache.counts.clear()
+    return counts
+
+
+def add_cache_counts(counts):
+    for name, render_cache in get_render_caches().items():
+        render_cache.counts.update(counts[name])
+
+
+def _timed_build_task(view, task):
+    start = time.perf_counter()
+    begin_output(restart=True)
+    try:
+        view.build_task(task)
+    finally:
+        end_output()
+    return os.getpid(), time.perf_counter() - start
+
+
+def get_view_path(view_class):
+    return '{0.__module__}.{0.__qualname__}'.format(view_class)
+
+
+def get_manifest():
+    return _manifest
+
+
+def set_manifest(manifest):
+    global _manifest
+    _manifest = manifest
+
+
+def sync_tree(source_dir, target_dir):
+    """
+    Copies the files under source_dir that are missing from target_dir, or
+    whose copies there differ, and returns the paths of the copies. Files
+    with the same size and modification time are assumed to be unchanged,
+    while ones only touched (as collectstatic's post-processing does) are
+    compared by content.
+    """
+
+    copied = []
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        target_dir_path = os.path.normpath(os.path.join(target_dir, os.path.relpath(dir_path, source_dir)))
+        for file_name in file_names:
+            source_path = os.path.join(dir_path, file_name)
+            target_path = os.path.join(target_dir_path, file_name)
+            source_stat = os.stat(source_path)
+            try:
+                target_stat = os.stat(target_path)
+            except OSError:
+                target_stat = None
+
+            if target_stat is None or target_stat.st_size != source_stat.st_size:
+                os.makedirs(target_dir_path, exist_ok=True)
+                shutil.copy2(source_path, target_path)
+                copied.append(target_path)
+            elif target_stat.st_mtime_ns != source_stat.st_mtime_ns:
+                if filecmp.cmp(source_path, target_path, shallow=False):
+                    shutil.copystat(source_path, target_path)
+                else:
+                    shutil.copy2(source_path, target_path)
+                    copied.append(target_path)
+    return copied
+
+
+@contextlib.contextmanager
+def build_lock(build_dir):
+    """
+    Holds an exclusive lock on the given build directory, waiting for it if
+    need be, so that builds and live rebuilds in different processes (e.g.
+    each of the server's workers) don't write to it at the same time.
+    """
+
+    path = build_dir.rstrip(os.sep) + '-build.lock'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info('Waiting for another build of %s to finish', build_dir)
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class BuildManifest(object):
+    """
+    Records the content each built file depended on, so that an incremental
+    build can skip files whose dependencies are unchanged since the previous
+    build and remove files that are no longer part of the site.
+
+    Only published content is tracked, so changes to templates or code
+    require a full build.
+
+    What every file depends on, such as the navigation and static files,
+    is saved once as a hash of the site's state (see ContentState), and
+    when it changes, every file is rebuilt. The options that shaped the
+    build's output, such as minification, are saved too, so that live
+    rebuilds (see blog.rebuild) can build files the same way.
+    """
+
+    version = 2
+
+    def __init__(self, build_dir, incremental=False, options=None):
+        self.build_dir = build_dir
+        self.path = build_dir.rstrip(os.sep) + '-manifest.json'
+        self.incremental = incremental
+        self.options = options or {}
+        self.entries = {}
+        self.previous_entries, self.previous_options, self.previous_site = self.load()
+        self._state = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}, None
+
+        if data.get('version') != self.version or data.get('build_dir') != self.build_dir:
+            return {}, {}, None
+        return data['entries'], data['options'], data['site']
+
+    def save(self):
+        data = {'version': self.version, 'build_dir': self.build_dir, 'options': self.options,
+                'site': self.state.site_hash, 'entries': self.entries}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = ContentState()
+        return self._state
+
+    @property
+    def site_changed(self):
+        return self.state.site_hash != self.previous_site
+
+    def needs_build(self, view, path, dependencies):
+        """
+        Records the dependencies of the file at the given path and returns
+        whether it needs to be built.
+        """
+
+        relative_path = os.path.relpath(path, self.build_dir)
+        # Round trip through JSON so entries compare equal to those loaded from disk
+        entry = json.loads(json.dumps({'view': get_view_path(type(view)), 'dependencies': dependencies}))
+        self.entries[relative_path] = entry
+
+        return not (self.incremental and
+                    not self.site_changed and
+                    self.previous_entries.get(relative_path) == entry and
+                    os.path.exists(path))
+
+    def finish(self, view_paths, scope=None):
+        """
+        Removes files built by the given views in the previous build that
+        weren't part of this one, then saves the manifest. If scope is given,
+        only the files at those relative paths can be removed, as when only
+        part of the site was rebuilt.
+        """
+
+        for relative_path, entry in self.previous_entries.items():
+            if relative_path in self.entries:
+                continue
+            if entry['view'] not in view_paths or (scope is not None and relative_path not in scope):
+                # Files of views that didn't run this time keep their entries, as do those out of scope, unless
+                # they were built for a different state of the site, in which case they're rebuilt the next time
+                if not self.site_changed:
+                    self.entries[relative_path] = entry
+                continue
+
+            path = os.path.join(self.build_dir, relative_path)
+            if os.path.exists(path):
+                logger.info('Removing %s', relative_path)
+                os.remove(path)
+                # Along with any precompressed siblings
+                for extension in ('.gz', '.br'):
+                    if os.path.exists(path + extension):
+                        os.remove(path + extension)
+                self.remove_empty_dirs(os.path.dirname(path))
+
+        self.save()
+
+    def remove_empty_dirs(self, path):
+        while os.path.abspath(path) != os.path.abspath(self.build_dir) and not os.listdir(path):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+
+class ContentState(object):
+    """
+    A snapshot of the published content that built files depend on, loaded
+    in a handful of queries regardless of the size of the site.
+    """
+
+    def __init__(self):
+        # Imported here as the models depend on this module
+        from wagtail.core.models import Page, Site, get_page_models
+        from wagtail.documents import get_document_model
+        from wagtail.images import get_image_model
+        from .blocks import get_references
+        from .models import BasePage, BlogIndex, BlogPost, BlogPostTag, ContentFlagsMixin, HeroImage
+
+        pages = Page.objects.live().public()
+        self.last_published = {page_id: last_published_at and last_published_at.isoformat()
+                               for page_id, last_published_at in pages.values_list('id', 'last_published_at')}
+
+        self.heroes = {hero.pop('id'): hero for hero in HeroImage.objects.values(
+            'id', 'wagtail_image__file', 'wagtail_image_dark__file', 'svg_image', 'svg_image_dark',
+            'add_parallax', 'repeat', 'position', 'text_color')}
+        self.page_heroes = dict(BasePage.objects.filter(hero_image__isnull=False).values_list('id', 'hero_image'))
+
+        # Pages, documents and images that the body of each page links to or shows, which rich text refers to by ID
+        # and only turns into URLs and renditions when rendered, along with what their output depends on
+        self.page_references = {}
+        for model in get_page_models():
+            if issubclass(model, ContentFlagsMixin) and not model._meta.abstract:
+                stream_block = model._meta.get_field(model.content_field_name).stream_block
+                for page_id, body in model.objects.live().public().values_list('id', model.content_field_name):
+                    self.page_references[page_id] = get_references(stream_block, body.raw_data)
+        self.references = {
+            'pages': dict(Page.objects.values_list('id', 'url_path')),
+            'documents': {document_id: [file, title] for document_id, file, title in
+                          get_document_model().objects.values_list('id', 'file', 'title')},
+            'images': {image_id: rest for image_id, *rest in get_image_model().objects.values_list(
+                'id', 'file', 'title', 'focal_point_x', 'focal_point_y', 'focal_point_width', 'focal_point_height')},
+        }
+
+        # Navigation links depend on the site root and the URLs of pages other than posts, and every page links to
+        # fingerprinted static files, which may be inlined as critical CSS, and pages may be minified
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+        self.site = {
+            'sites': list(Site.objects.order_by('id').values_list('hostname', 'port', 'root_page', 'is_default_site')),
+            'pages': dict(pages.not_type(BlogPost).values_list('id', 'url_path')),
+            'static': {name: hashed_files.get(name) for name in get_template_static_files()},
+            'critical_css': get_critical_css() is not None,
+            'minify_html': get_minifier() is not None,
+        }
+        self.site_hash = hashlib.sha256(json.dumps(self.site, sort_keys=True).encode()).hexdigest()
+
+        # Public posts of each index, newest first, as in BlogIndex.paginate, and of each of its archives, so that
+        # looking up a listing or a post's neighbours doesn't take a pass over every post
+        indexes_by_path = dict(BlogIndex.objects.values_list('path', 'id'))
+        post_tags = defaultdict(set)
+        for post_id, tag_name in BlogPostTag.objects.values_list('content_object', 'tag__name'):
+            post_tags[post_id].add(tag_name)
+
+        self.archives = defaultdict(list)
+        self.post_indexes = {}
+        self.post_positions = {}
+        posts = BlogPost.objects.live().public().order_by('-pub_date', '-id').values_list('id', 'path', 'pub_date')
+        for post_id, path, pub_date in posts:
+            index_id = indexes_by_path.get(path[:-BlogPost.steplen])
+            if index_id is not None:
+                pub_date = localtime(pub_date)
+                self.post_indexes[post_id] = index_id
+                self.post_positions[post_id] = len(self.archives[index_id, 'all_posts'])
+                self.archives[index_id, 'all_posts'].append(post_id)
+                self.archives[index_id, 'year', pub_date.year].append(post_id)
+                self.archives[index_id, 'month', pub_date.year, pub_date.month].append(post_id)
+                for tag_name in post_tags[post_id]:
+                    self.archives[index_id, 'tag', tag_name].append(post_id)
+
+    def dependencies(self, *page_ids):
+        heroes = {self.page_heroes[page_id] for page_id in page_ids if page_id in self.page_heroes}
+        references = {kind: set() for kind in self.references}
+        for page_id in page_ids:
+            for kind, ids in self.page_references.get(page_id, {}).items():
+                references[kind] |= ids
+        return {
+            'pages': {page_id: self.last_published.get(page_id) for page_id in page_ids if page_id is not None},
+            'heroes': {hero_id: self.heroes.get(hero_id) for hero_id in heroes},
+            'references': {kind: {reference_id: self.references[kind].get(reference_id) for reference_id in ids}
+                           for kind, ids in references.items()},
+        }
+
+    def archive_posts(self, index_id, view_name, view_kwargs):
+        """
+        Returns the IDs of the posts listed by a BlogIndex route, newest first.
+        The list is shared, so it mustn't be modified.
+        """
+
+        if view_name == 'posts_by_tag':
+            key = (index_id, 'tag', view_kwargs['tag'])
+        elif view_name == 'posts_by_date' and view_kwargs.get('month') is None:
+            key = (index_id, 'year', view_kwargs['year'])
+        elif view_name == 'posts_by_date':
+            key = (index_id, 'month', view_kwargs['year'], view_kwargs['month'])
+        else:
+            key = (index_id, 'all_posts')
+        return self.archives.get(key, [])
+
+    def neighbours(self, post_id):
+        """
+        Returns the IDs of the posts before and after the given one.
+        """
+
+        post_ids = self.archives[self.post_indexes[post_id], 'all_posts']
+        position = self.post_positions[post_id]
+        prev_id = post_ids[position + 1] if position + 1 < len(post_ids) else None
+        next_id = post_ids[position - 1] if position > 0 else None
+        return prev_id, next_id
+
+
+def get_template_static_files():
+    """
+    Returns the names of the static files that the project's templates link
+    to, whose fingerprinted URLs built pages depend on. Files referenced by
+    stylesheets are covered by the stylesheets' own fingerprints.
+    """
+
+    names = set(settings.BUILD_CRITICAL_CSS)
+    for template_dir in engines['django'].engine.dirs:
+        for dir_path, dir_names, file_names in os.walk(template_dir):
+            for file_name in file_names:
+                with open(os.path.join(dir_path, file_name), encoding='utf-8') as f:
+                    names.update(STATIC_TAG_RE.findall(f.read()))
+    return sorted(names)
@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import json
+import threading
+import uuid
+from collections import Counter, OrderedDict
+
+import pygments
+import wagtail
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+
+class BlogIndexCache(object):
+    """
+    Per-process cache of data derived from the posts of each BlogIndex,
+    keyed by the index's tree path plus any further arguments to the compute
+    function, and computed on first use. At most max_size values are kept,
+    least recently used first out.
+
+    Cached values are discarded whenever the posts may have changed (see
+    blog.signals). Invalidation goes through a token in the Django cache
+    named by settings.INVALIDATION_CACHE, so it reaches every process.
+    """
+
+    token_key = 'blog.index_cache.token'
+
+    def __init__(self, compute, max_size=64):
+        self.compute = compute
+        self.values = LRUCache(max_size)
+        self.token = None
+
+    def get(self, path, *args):
+        token = get_token(self.token_key)
+        if token != self.token:
+            # Everything cached so far was computed before the change
+            self.values.clear()
+            self.token = token
+
+        key = (path,) + args
+        cached = self.values.get(key)
+        if cached is None or cached[0] != token:
+            cached = (token, self.compute(path, *args))
+            self.values.set(key, cached)
+        return cached[1]
+
+    @classmethod
+    def invalidate(cls):
+        replace_token(cls.token_key)
+
+
+def get_token(key):
+    """
+    Returns the current value of an invalidation token, which is replaced
+    by replace_token(), creating it if need be.
+    """
+
+    backend = caches[settings.INVALIDATION_CACHE]
+    token = backend.get(key)
+    if token is None:
+        backend.add(key, uuid.uuid4().hex, None)
+        token = backend.get(key)
+    return token
+
+
+def replace_token(key):
+    caches[settings.INVALIDATION_CACHE].delete(key)
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache that discards the least recently used
+    values once it holds more than max_size of them.
+    """
+
+    missing = object()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.values:
+                return default
+            self.values.move_to_end(key)
+            return self.values[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class HighlightCache(object):
+    """
+    Cache of syntax highlighted code, keyed by a hash of the code, language,
+    formatter options and Pygments version. Lookups go through a small
+    in-process LRU, then the Django cache named by settings.HIGHLIGHT_CACHE
+    (if any), which can be a persistent backend so that results survive
+    between builds.
+    """
+
+    def __init__(self, max_size=256):
+        self.memory = LRUCache(max_size)
+        self.counts = Counter()
+
+    @property
+    def persistent(self):
+        return caches[settings.HIGHLIGHT_CACHE] if settings.HIGHLIGHT_CACHE else None
+
+    def get(self, code, language, options, highlight):
+        """
+        Returns the highlighted code, calling highlight() to produce it if
+        it isn't cached.
+        """
+
+        key = 'blog.highlight.' + hashlib.sha256(json.dumps(
+            [code, language, options, pygments.__version__], sort_keys=True).encode()).hexdigest()
+
+        result = self.memory.get(key, LRUCache.missing)
+        if result is not LRUCache.missing:
+            self.counts['memory_hits'] += 1
+            return result
+
+        persistent = self.persistent
+        result = persistent.get(key) if persistent else None
+        if result is not None:
+            self.counts['persistent_hits'] += 1
+        else:
+            self.counts['misses'] += 1
+            result = highlight()
+            if persistent:
+                persistent.set(key, result, None)
+
+        self.memory.set(key, result)
+        return result
+
+    def clear(self):
+        """
+        Empties the in-process LRU and resets the counts. The persistent
+        cache, if any, is left alone.
+        """
+
+        self.memory.clear()
+        self.counts.clear()
+
+
+class FragmentCache(object):
+    """
+    In-process cache of rendered fragments of posts, such as the summaries
+    shown on each listing a post appears on. Keys include the post's live
+    revision and URL path, plus a token that is replaced whenever pages or
+    media that rich text may link to change (see blog.signals), as links are
+    stored by ID and only expanded when rendered. Old fragments just age out
+    of the LRU.
+    """
+
+    references_key = 'blog.fragments.references'
+
+    def __init__(self, max_size=2048):
+        self.memory = LRUCache(max_size)
+        self.counts = Counter()
+
+    def get(self, post, variant, render):
+        """
+        Returns the given variant of the post's fragment, calling render() to
+        produce it if it isn't cached.
+        """
+
+        # Pages always hold their live content, so only posts that were never published (e.g. in previews) are
+        # left uncached
+        if post.live_revision_id is None:
+            return render()
+
+        key = (post.id, post.live_revision_id, post.url_path, variant, get_token(self.references_key))
+        result = self.memory.get(key)
+        if result is not None:
+            self.counts['hits'] += 1
+            return result
+
+        self.counts['misses'] += 1
+        result = render()
+        self.memory.set(key, result)
+        return result
+
+    def invalidate_references(self):
+        replace_token(self.references_key)
+
+    def clear(self):
+        self.memory.clear()
+        self.counts.clear()
+
+
+class BlockRenderCache(object):
+    """
+    Opt-in cache of rendered stream blocks, stored in the Django cache named
+    by settings.BLOCK_RENDER_CACHE (if any). Eviction is left to the backend,
+    so it should have a MAX_ENTRIES bound.
+
+    Keys are a hash of the block's type and raw value, the source of its
+    template and the Wagtail and Pygments versions, so unchanged blocks are
+    shared across requests, revisions and pages. Blocks that depend on other
+    content, like the pages they link to or the images they show, also
+    include a token that is replaced whenever such content changes (see
+    blog.signals). Bump version when block rendering code changes.
+    """
+
+    version = 1
+    references_key = 'blog.block_render.references'
+
+    @property
+    def backend(self):
+        return caches[settings.BLOCK_RENDER_CACHE] if settings.BLOCK_RENDER_CACHE else None
+
+    def get(self, block, raw_value, references_content, render):
+        """
+        Returns the rendered block, calling render() to produce it if it isn't
+        cached.
+        """
+
+        backend = self.backend
+        if backend is None:
+            return render()
+
+        parts = [self.version, block.name, raw_value, get_template_version(block.meta.template),
+                 wagtail.__version__, pygments.__version__]
+        if references_content:
+            parts.append(self.get_references_token(backend))
+        key = 'blog.block_render.' + hashlib.sha256(json.dumps(
+            parts, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+        result = backend.get(key)
+        if result is None:
+            result = render()
+            backend.set(key, result, None)
+        return mark_safe(result)
+
+    def get_references_token(self, backend):
+        token = backend.get(self.references_key)
+        if token is None:
+            backend.add(self.references_key, uuid.uuid4().hex, None)
+            token = backend.get(self.references_key)
+        return token
+
+    def invalidate_references(self):
+        backend = self.backend
+        if backend is not None:
+            backend.delete(self.references_key)
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_version(template_name):
+    if template_name is None:
+        return None
+    return hashlib.sha256(get_template(template_name).template.source.encode()).hexdigest()
@@ -0,0 +1,162 @@
+import gzip
+import logging
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+# The compressor of the build in progress, if any
+_compressor = None
+
+# Paths written by a worker process since its last task, to be compressed by the parent
+_worker_paths = []
+
+
+def compress_gzip(data):
+    # A fixed mtime keeps the output identical between builds
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+class Compressor(object):
+    """
+    Writes precompressed .gz (and .br, if the brotli package is installed)
+    siblings of built files in a pool of threads, so that compression
+    overlaps with rendering. Files smaller than settings.BUILD_COMPRESSION_MIN_SIZE,
+    and those that don't get any smaller, are left uncompressed.
+    """
+
+    def __init__(self, threads=None):
+        self.formats = [('.gz', compress_gzip)]
+        if brotli is not None:
+            self.formats.append(('.br', compress_brotli))
+
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(threads or os.cpu_count())
+        self.futures = []
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def __getstate__(self):
+        # Worker processes started with "spawn" get a copy only to know that compression is on (see compress_output())
+        return {'pid': self.pid}
+
+    def should_compress(self, path):
+        return os.path.splitext(path)[1].lower() in settings.BUILD_COMPRESSED_EXTENSIONS
+
+    def submit(self, path, data=None):
+        if self.should_compress(path):
+            self.futures.append(self.executor.submit(self.compress, path, data))
+
+    def submit_tree(self, path, changed=None):
+        """
+        Queues the files under the given directory. If changed is given, only
+        those paths are, plus any files big enough to compress that have no
+        compressed siblings yet (e.g. after a build without compression).
+        """
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                if not file_name.endswith(tuple(extension for extension, compress in self.formats)):
+                    file_path = os.path.join(dir_path, file_name)
+                    if (changed is None or file_path in changed or
+                            (os.path.getsize(file_path) >= settings.BUILD_COMPRESSION_MIN_SIZE and
+                             not os.path.exists(file_path + self.formats[0][0]))):
+                        self.submit(file_path)
+
+    def compress(self, path, data=None):
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        elif isinstance(data, str):
+            data = data.encode()
+
+        for extension, compress in self.formats:
+            compressed_path = path + extension
+            compressed = compress(data) if len(data) >= settings.BUILD_COMPRESSION_MIN_SIZE else None
+
+            if compressed is None or len(compressed) >= len(data):
+                # Don't leave behind a sibling from a previous build of a bigger version of the file
+                if os.path.exists(compressed_path):
+                    os.remove(compressed_path)
+                continue
+
+            with open(compressed_path, 'wb') as f:
+                f.write(compressed)
+
+            with self.lock:
+                self.counts[extension, 'files'] += 1
+                self.counts[extension, 'original'] += len(data)
+                self.counts[extension, 'compressed'] += len(compressed)
+
+    def finish(self):
+        """
+        Waits for outstanding files, logs the bytes saved and raises the first
+        error encountered, if any.
+        """
+
+        self.executor.shutdown(wait=True)
+        errors = [future.exception() for future in self.futures if future.exception() is not None]
+
+        for extension, compress in self.formats:
+            original = self.counts[extension, 'original']
+            compressed = self.counts[extension, 'compressed']
+            logger.info('Compressed %d files to %s: %d bytes saved (%.1f%%)', self.counts[extension, 'files'],
+                        extension, original - compressed, 100 * (original - compressed) / original if original else 0)
+
+        if errors:
+            logger.error('%d files failed to compress', len(errors))
+            raise errors[0]
+
+
+def get_compressor():
+    return _compressor
+
+
+def set_compressor(compressor):
+    global _compressor
+    _compressor = compressor
+
+
+def compress_output(path, data=None):
+    """
+    Queues a built file for compression if a build with compression is in
+    progress. Worker processes can't reach the parent's thread pool, so they
+    hold on to the path until take_worker_paths() is called.
+    """
+
+    if _compressor is None:
+        return
+    if _compressor.pid == os.getpid():
+        _compressor.submit(path, data)
+    else:
+        _worker_paths.append(path)
+
+
+def take_worker_paths():
+    paths = list(_worker_paths)
+    del _worker_paths[:]
+    return paths
+
+
+class CompressOutputMixin(object):
+    """
+    Mixin for bakery views that compresses each file they build.
+    """
+
+    def build_file(self, path, html):
+        super().build_file(path, html)
+        compress_output(path, html)
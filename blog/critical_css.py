@@ -0,0 +1,196 @@
+import re
+from html.parser import HTMLParser
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+
+
+# The critical CSS extractor of the build in progress, if any
+_critical_css = None
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+LINK_RE = re.compile(r'<link\b[^>]*>')
+BODY_RE = re.compile(r'<body\b')
+HREF_RE = re.compile(r'\bhref="([^"]*)"')
+# Arguments of :not() and friends only ever narrow a match, so they can be dropped along with other pseudo-classes
+PSEUDO_RE = re.compile(r'::?[\w-]+(\([^()]*(\([^()]*\)[^()]*)*\))?')
+ATTRIBUTE_RE = re.compile(r'\[[^\]]*\]')
+# States that only follow interaction, which the page doesn't need to render
+INTERACTION_RE = re.compile(r':(?:hover|active|focus)\b')
+SIMPLE_SELECTOR_RE = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*)')
+
+
+class Rule(object):
+    """
+    A rule of a stylesheet: either a style rule with its selectors, or an
+    at-rule with its nested rules (None for those without any, such as
+    @font-face, which are always kept).
+    """
+
+    def __init__(self, prelude, body=None, children=None):
+        self.prelude = ' '.join(prelude.split())
+        self.body = body and ' '.join(body.split())
+        self.children = children
+
+        self.selectors = None
+        if not self.prelude.startswith('@'):
+            self.selectors = [selector_requirements(selector) for selector in self.prelude.split(',')
+                              if not INTERACTION_RE.search(selector)]
+
+    def matches(self, present):
+        return present is None or any(requirements <= present for requirements in self.selectors)
+
+    def render(self, present):
+        if self.selectors is not None:
+            return '{}{{{}}}'.format(self.prelude, self.body) if self.matches(present) else ''
+        if self.children is None:
+            return '{}{{{}}}'.format(self.prelude, self.body)
+        children = ''.join(child.render(present) for child in self.children)
+        return '{}{{{}}}'.format(self.prelude, children) if children else ''
+
+
+def selector_requirements(selector):
+    """
+    Returns the tags, classes (prefixed with ".") and IDs (prefixed with "#")
+    that must all appear in a page for the selector to possibly match.
+    """
+
+    selector = ATTRIBUTE_RE.sub('', PSEUDO_RE.sub('', selector))
+    return frozenset(prefix + (name if prefix else name.lower())
+                     for prefix, name in SIMPLE_SELECTOR_RE.findall(selector))
+
+
+def parse_rules(css):
+    """
+    Parses a stylesheet into a list of Rules. Only as much of CSS as our own
+    stylesheets use is supported.
+    """
+
+    rules, position = _parse_block(COMMENT_RE.sub('', css), 0)
+    return rules
+
+
+def _parse_block(css, position):
+    rules = []
+    while True:
+        start = position
+        while position < len(css) and css[position] not in '{}':
+            position += 1
+        if position >= len(css) or css[position] == '}':
+            return rules, position + 1
+
+        prelude = css[start:position]
+        if prelude.strip().startswith(('@media', '@supports')):
+            children, position = _parse_block(css, position + 1)
+            rules.append(Rule(prelude, children=children))
+        else:
+            end = css.index('}', position)
+            rules.append(Rule(prelude, body=css[position + 1:end]))
+            position = end + 1
+
+
+class PresenceParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.present = set()
+
+    def handle_starttag(self, tag, attrs):
+        self.present.add(tag)
+        for name, value in attrs:
+            if name == 'class' and value:
+                self.present.update('.' + class_name for class_name in value.split())
+            elif name == 'id' and value:
+                self.present.add('#' + value)
+
+
+class CriticalCSS(object):
+    """
+    Inlines the rules of the stylesheets in settings.BUILD_CRITICAL_CSS that
+    may apply to the top of each built page, and loads the full stylesheets
+    without blocking rendering. A rule is kept if every tag, class and ID in
+    one of its selectors appears in the first fold characters of the page's
+    body, so that what's shown first renders styled before the rest arrives.
+
+    Inlined rules are sent again with the full stylesheet, so if they would
+    come to more than max_ratio of it, the stylesheet is left as it is.
+    """
+
+    def __init__(self, paths=None, fold=None, max_ratio=None):
+        if paths is None:
+            paths = settings.BUILD_CRITICAL_CSS
+        self.fold = settings.BUILD_CRITICAL_CSS_FOLD if fold is None else fold
+        self.max_ratio = settings.BUILD_CRITICAL_CSS_MAX_RATIO if max_ratio is None else max_ratio
+
+        self.stylesheets = {}
+        for path in paths:
+            with open(finders.find(path), encoding='utf-8') as f:
+                rules = parse_rules(f.read())
+            self.stylesheets[static(path)] = (rules, len(render_rules(rules, None)))
+
+    def process(self, html):
+        is_bytes = isinstance(html, bytes)
+        if is_bytes:
+            html = html.decode()
+
+        present = None
+        for match in reversed(list(LINK_RE.finditer(html))):
+            link = match.group(0)
+            href = HREF_RE.search(link)
+            if 'rel="stylesheet"' not in link or not href or href.group(1) not in self.stylesheets:
+                continue
+
+            if present is None:
+                present = self.get_present(html)
+
+            rules, size = self.stylesheets[href.group(1)]
+            critical = render_rules(rules, present)
+            if len(critical) > size * self.max_ratio:
+                continue
+            deferred = ('<style>{}</style><link rel="preload" href="{}" as="style" '
+                        'onload="this.onload=null;this.rel=\'stylesheet\'"/><noscript>{}</noscript>').format(
+                            critical, href.group(1), link)
+            html = html[:match.start()] + deferred + html[match.end():]
+
+        return html.encode() if is_bytes else html
+
+    def get_present(self, html):
+        """
+        Returns the tags, classes and IDs used above the fold of the page.
+        """
+
+        body = BODY_RE.search(html)
+        parser = PresenceParser()
+        parser.feed(html[:(body.start() if body else 0) + self.fold])
+        return parser.present | {'html', 'body'}
+
+
+def render_rules(rules, present):
+    """
+    Returns the rules that may apply to a page with the given tags, classes
+    and IDs, or all of them if present is None, as CSS.
+    """
+
+    return ''.join(rule.render(present) for rule in rules)
+
+
+def get_critical_css():
+    return _critical_css
+
+
+def set_critical_css(critical_css):
+    global _critical_css
+    _critical_css = critical_css
+
+
+class CriticalCSSMixin(object):
+    """
+    Mixin for bakery views that inlines critical CSS into each file they
+    build, if the build has it enabled.
+    """
+
+    def get_content(self, *args, **kwargs):
+        content = super().get_content(*args, **kwargs)
+        if _critical_css is not None:
+            content = _critical_css.process(content)
+        return content
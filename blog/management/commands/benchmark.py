@@ -0,0 +1,122 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import django
+import wagtail
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from blog.benchmark import clear_caches, generate_site, get_cache_settings, measure_views
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic sites of the given sizes in a throwaway SQLite database, then time the build and '
+            'individual views and report the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000],
+                            help='Numbers of posts to benchmark with. Defaults to 100, 1000 and 10000.')
+        parser.add_argument('--tags', type=int, default=20, help='Number of distinct tags.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of warm requests to time per view, after the first cold one.')
+        parser.add_argument('--samples', type=int, default=3, help='Number of posts to time.')
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker processes to build with.')
+        parser.add_argument('--skip-build', action='store_true', help="Don't time the build.")
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated content.')
+        parser.add_argument('--output', help='File to write the results to. Will use stdout by default.')
+        parser.add_argument('--keep', action='store_true',
+                            help="Don't delete the temporary directory holding the databases and build output.")
+
+    def handle(self, *args, **options):
+        results = {
+            'created': timezone.now().isoformat(),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'wagtail': wagtail.__version__,
+            'options': {key: options[key] for key in ('tags', 'repeat', 'samples', 'workers', 'seed')},
+            'runs': [],
+        }
+
+        temp_dir = tempfile.mkdtemp(prefix='npweb-benchmark-')
+        try:
+            for size in options['sizes']:
+                results['runs'].append(self.run(os.path.join(temp_dir, str(size)), size, options))
+        finally:
+            if options['keep']:
+                self.stderr.write('Kept {}'.format(temp_dir))
+            else:
+                shutil.rmtree(temp_dir)
+
+        output = json.dumps(results, indent=4)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, run_dir, size, options):
+        self.stderr.write('Benchmarking {} posts in {}'.format(size, run_dir))
+        os.makedirs(run_dir)
+
+        connection.settings_dict['TEST']['NAME'] = os.path.join(run_dir, 'db.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(run_dir, 'media'),
+                                   STATIC_ROOT=os.path.join(run_dir, 'static'),
+                                   BUILD_DIR=os.path.join(run_dir, 'build'),
+                                   CACHES=get_cache_settings(os.path.join(run_dir, 'cache')),
+                                   HIGHLIGHT_CACHE=None):
+                start = time.perf_counter()
+                index = generate_site(size, options['tags'], seed=options['seed'])
+                run = {'posts': size, 'generate_seconds': time.perf_counter() - start}
+
+                run['views'] = measure_views(index, options['repeat'], options['samples'])
+                if not options['skip_build']:
+                    run['build'] = self.time_build(options['workers'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        return run
+
+    def time_build(self, workers):
+        clear_caches()
+
+        # Queries made by worker processes aren't captured, so only count them for serial builds
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            call_command('build', workers=workers, verbosity=0)
+            elapsed = time.perf_counter() - start
+
+        files = 0
+        total_bytes = 0
+        for dir_path, dir_names, file_names in os.walk(settings.BUILD_DIR):
+            for file_name in file_names:
+                files += 1
+                total_bytes += os.path.getsize(os.path.join(dir_path, file_name))
+
+        return {
+            'seconds': elapsed,
+            'queries': len(context.captured_queries) if workers == 1 else None,
+            'files': files,
+            'bytes': total_bytes,
+        }
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              check=True, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,217 @@
+import logging
+import os
+import shutil
+
+from bakery.management.commands.build import Command as BuildCommand
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from blog.blocks import highlight_cache
+from blog.build import BuildManifest, build_lock, set_manifest, sync_tree
+from blog.compression import Compressor, set_compressor
+from blog.critical_css import CriticalCSS, set_critical_css
+from blog.minify import HTMLMinifier, set_minifier
+from blog.models import HeroImage, load_hero_images, post_fragments, set_hero_images
+from blog.renditions import build_renditions
+from blog.report import BuildReport, set_report, take_records
+from blog.writer import OutputWriter, set_writer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BuildCommand):
+    """
+    Bakery's build command, plus options for the build features in blog.build.
+    """
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--workers',
+            action='store',
+            dest='workers',
+            type=int,
+            default=None,
+            help='Number of worker processes to build pages with. Will use settings.BUILD_WORKERS by default.'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only build files whose content has changed since the last build. Implies --keep-build-dir.'
+        )
+        parser.add_argument(
+            '--skip-renditions',
+            action='store_true',
+            dest='skip_renditions',
+            default=False,
+            help="Skip generating missing image renditions before building pages. They'll be generated while "
+                 "rendering instead."
+        )
+        parser.add_argument(
+            '--skip-compression',
+            action='store_true',
+            dest='skip_compression',
+            default=False,
+            help="Skip writing precompressed copies of built files."
+        )
+        parser.add_argument(
+            '--critical-css',
+            action='store_true',
+            dest='critical_css',
+            default=False,
+            help='Inline the rules of the stylesheets in settings.BUILD_CRITICAL_CSS that each page uses, and load '
+                 'the full stylesheets without blocking rendering.'
+        )
+        parser.add_argument(
+            '--minify-html',
+            action='store_true',
+            dest='minify_html',
+            default=False,
+            help='Remove comments and collapse whitespace in built pages, leaving preformatted text, scripts and '
+                 'math as they are.'
+        )
+        parser.add_argument(
+            '--report',
+            action='store',
+            dest='report',
+            default=None,
+            help='Write the time, queries and size of each built file to the given path, as CSV if it ends with '
+                 '.csv or JSON otherwise.'
+        )
+        parser.add_argument(
+            '--report-top',
+            action='store',
+            dest='report_top',
+            type=int,
+            default=10,
+            help='Number of slowest files to log when reporting. Defaults to 10.'
+        )
+        parser.add_argument(
+            '--query-budget',
+            action='store',
+            dest='query_budget',
+            type=int,
+            default=None,
+            help='Fail the build if any file takes more than this many queries to build. Implies reporting.'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('incremental'):
+            options['keep_build_dir'] = True
+        with build_lock(options.get('build_dir') or settings.BUILD_DIR):
+            super().handle(*args, **options)
+
+    def set_options(self, *args, **options):
+        super().set_options(*args, **options)
+
+        if options.get('workers') is not None:
+            settings.BUILD_WORKERS = options['workers']
+
+        self.incremental = options.get('incremental')
+        self.renditions_pending = not options.get('skip_renditions')
+        self.compressor = None if options.get('skip_compression') else Compressor()
+        self.critical_css = options.get('critical_css')
+        self.minifier = HTMLMinifier() if options.get('minify_html') else None
+
+        self.report_path = options.get('report')
+        self.report_top = options.get('report_top')
+        self.query_budget = options.get('query_budget')
+        self.report = BuildReport() if self.report_path or self.query_budget is not None else None
+
+    def build_static(self, *args, **options):
+        target_dir = os.path.join(self.build_dir, settings.STATIC_URL.lstrip('/'))
+        if not self.incremental:
+            super().build_static(*args, **options)
+            if self.compressor:
+                self.compressor.submit_tree(target_dir)
+            return
+
+        # As bakery does, but only copying and compressing the files that changed since the previous build
+        call_command('collectstatic', interactive=False, verbosity=0)
+        copied = set(sync_tree(self.static_root, target_dir)) if settings.STATIC_URL else set()
+        for name in ('robots.txt', 'favicon.ico'):
+            if os.path.join(target_dir, name) in copied:
+                shutil.copy2(os.path.join(target_dir, name), os.path.join(self.build_dir, name))
+        logger.info('Static files: %d copied', len(copied))
+        if self.compressor:
+            self.compressor.submit_tree(target_dir, copied)
+
+    def build_media(self):
+        # Renditions and optimized SVGs are media files, so they have to exist before the media directory is copied
+        self.pregenerate_renditions()
+        for hero in HeroImage.objects.exclude(svg_image=''):
+            hero.optimize_svgs()
+        if not self.incremental:
+            super().build_media()
+        elif os.path.exists(self.media_root) and settings.MEDIA_URL:
+            copied = sync_tree(self.media_root, os.path.join(self.build_dir, settings.MEDIA_URL.lstrip('/')))
+            logger.info('Media files: %d copied', len(copied))
+
+    def pregenerate_renditions(self):
+        if self.renditions_pending:
+            build_renditions()
+            self.renditions_pending = False
+
+    def build_views(self):
+        self.pregenerate_renditions()
+
+        manifest = BuildManifest(self.build_dir, incremental=self.incremental, options={
+            'compression': self.compressor is not None,
+            'critical_css': self.critical_css,
+            'minify_html': self.minifier is not None,
+        })
+        set_manifest(manifest)
+        writer = OutputWriter()
+        set_writer(writer)
+        set_compressor(self.compressor)
+        # Stylesheets are read once collectstatic has run, so that their fingerprinted URLs are known
+        set_critical_css(CriticalCSS() if self.critical_css else None)
+        set_minifier(self.minifier)
+        set_report(self.report)
+        # Heroes are shared by many pages, so load them all up front, before any worker processes are forked
+        set_hero_images(load_hero_images())
+        try:
+            super().build_views()
+        finally:
+            set_manifest(None)
+            set_writer(None)
+            set_compressor(None)
+            set_critical_css(None)
+            set_minifier(None)
+            set_report(None)
+            set_hero_images(None)
+            # Wait for the files even if the build failed, so that no threads are left writing to the build dir
+            writer.wait()
+        writer.finish()
+        manifest.finish(self.view_list)
+        if self.compressor:
+            self.compressor.finish()
+        if self.minifier:
+            self.minifier.finish()
+
+        counts = highlight_cache.counts
+        logger.info('Highlight cache: %d memory hits, %d persistent hits, %d misses',
+                    counts['memory_hits'], counts['persistent_hits'], counts['misses'])
+        counts = post_fragments.counts
+        logger.info('Post fragment cache: %d hits, %d misses', counts['hits'], counts['misses'])
+
+        if self.report:
+            self.finish_report()
+
+    def finish_report(self):
+        self.report.add(take_records())
+        self.report.log_summary(self.report_top)
+        if self.report_path:
+            self.report.write(self.report_path)
+
+        if self.query_budget is not None:
+            over_budget = self.report.over_budget(self.query_budget)
+            if over_budget:
+                raise CommandError('{} files took more than {} queries to build, including {}'.format(
+                    len(over_budget), self.query_budget,
+                    ', '.join('{path} ({queries})'.format(**record) for record in over_budget[:5])))
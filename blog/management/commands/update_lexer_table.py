@@ -0,0 +1,18 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from blog.blocks import LEXER_TABLE_PATH, build_lexer_table
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the table of code block languages, e.g. after upgrading Pygments'
+
+    def handle(self, *args, **options):
+        table = build_lexer_table()
+        with open(LEXER_TABLE_PATH, 'w') as f:
+            json.dump(table, f, indent=4)
+            f.write('\n')
+
+        self.stdout.write('Wrote {} languages for Pygments {}'.format(len(table['languages']),
+                                                                       table['pygments_version']))
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:26
+
+import blog.blocks
+from django.db import migrations
+import wagtail.core.blocks
+import wagtail.core.fields
+import wagtail.documents.blocks
+import wagtail.embeds.blocks
+import wagtail.images.blocks
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_hero_images_dark_mode'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='aboutpage',
+            name='body',
+            field=wagtail.core.fields.StreamField([('text', blog.blocks.CleanedRichTextBlock(features=['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'bold', 'italic', 'ol', 'ul', 'link', 'document', 'code'], template='blog/blocks/rich_text.html')), ('code', wagtail.core.blocks.StructBlock([('code', wagtail.core.blocks.TextBlock()), ('language', wagtail.core.blocks.ChoiceBlock(choices=blog.blocks.get_lexer_choices, required=False))])), ('math', blog.blocks.MathBlock()), ('image_row', wagtail.core.blocks.StructBlock([('images', wagtail.core.blocks.ListBlock(wagtail.core.blocks.StructBlock([('image', wagtail.images.blocks.ImageChooserBlock()), ('weight', wagtail.core.blocks.IntegerBlock(default=1, help_text='How much space to allocate to this image relative to others', max_value=99, min_value=1))]))), ('caption', wagtail.core.blocks.CharBlock(required=False))])), ('full_bleed_image', wagtail.core.blocks.StructBlock([('image', wagtail.images.blocks.ImageChooserBlock()), ('caption', wagtail.core.blocks.CharBlock(required=False)), ('add_parallax', wagtail.core.blocks.BooleanBlock())])), ('embed', wagtail.embeds.blocks.EmbedBlock()), ('document', wagtail.documents.blocks.DocumentChooserBlock())]),
+        ),
+        migrations.AlterField(
+            model_name='blogpost',
+            name='body',
+            field=wagtail.core.fields.StreamField([('text', blog.blocks.CleanedRichTextBlock(features=['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'bold', 'italic', 'ol', 'ul', 'link', 'document', 'code'], template='blog/blocks/rich_text.html')), ('code', wagtail.core.blocks.StructBlock([('code', wagtail.core.blocks.TextBlock()), ('language', wagtail.core.blocks.ChoiceBlock(choices=blog.blocks.get_lexer_choices, required=False))])), ('math', blog.blocks.MathBlock()), ('image_row', wagtail.core.blocks.StructBlock([('images', wagtail.core.blocks.ListBlock(wagtail.core.blocks.StructBlock([('image', wagtail.images.blocks.ImageChooserBlock()), ('weight', wagtail.core.blocks.IntegerBlock(default=1, help_text='How much space to allocate to this image relative to others', max_value=99, min_value=1))]))), ('caption', wagtail.core.blocks.CharBlock(required=False))])), ('full_bleed_image', wagtail.core.blocks.StructBlock([('image', wagtail.images.blocks.ImageChooserBlock()), ('caption', wagtail.core.blocks.CharBlock(required=False)), ('add_parallax', wagtail.core.blocks.BooleanBlock())])), ('embed', wagtail.embeds.blocks.EmbedBlock()), ('document', wagtail.documents.blocks.DocumentChooserBlock())]),
+        ),
+    ]
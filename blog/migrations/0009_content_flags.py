@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:27
+
+import re
+
+from django.db import migrations, models
+
+
+def text_contains_math(source):
+    return re.search(r'(?:\\\[.*\\\])|(?:\\\(.*\\\))', source) is not None
+
+
+def populate_content_flags(apps, schema_editor):
+    for model_name in ('AboutPage', 'BlogPost'):
+        for page in apps.get_model('blog', model_name).objects.all():
+            blocks = page.body.raw_data
+            text_indexes = [i for i, block in enumerate(blocks) if block['type'] == 'text']
+
+            page.has_math = any(block['type'] == 'math' or
+                                (block['type'] == 'text' and text_contains_math(block['value']))
+                                for block in blocks)
+            page.has_code = any(block['type'] == 'code' for block in blocks)
+            page.first_text_block_index = text_indexes[0] if text_indexes else None
+            page.first_text_block_has_math = bool(text_indexes) and text_contains_math(blocks[text_indexes[0]]['value'])
+            page.block_count = len(blocks)
+            page.save(update_fields=['has_math', 'has_code', 'first_text_block_index', 'first_text_block_has_math',
+                                     'block_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_lazy_lexer_choices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aboutpage',
+            name='block_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='aboutpage',
+            name='first_text_block_has_math',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='aboutpage',
+            name='first_text_block_index',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='aboutpage',
+            name='has_code',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='aboutpage',
+            name='has_math',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='block_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='first_text_block_has_math',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='first_text_block_index',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='has_code',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='has_math',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(populate_content_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_content_flags'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blogpost',
+            index=models.Index(fields=['pub_date', 'basepage_ptr'], name='blog_blogpo_pub_dat_b05f88_idx'),
+        ),
+    ]
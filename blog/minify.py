@@ -0,0 +1,131 @@
+import logging
+import os
+import re
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+# The HTML minifier of the build in progress, if any
+_minifier = None
+
+# Sizes of the files minified by a worker process since its last task, to be added up by the parent
+_worker_counts = Counter()
+
+# Comments, elements whose content must be kept exactly as it is, and other tags. Tags are matched quote by quote,
+# so that a ">" in an attribute value doesn't end them.
+TOKEN_RE = re.compile(r'''
+    (?P<comment><!--.*?-->)
+  | (?P<raw><(?P<raw_tag>pre|code|textarea|script|style)\b.*?</(?P=raw_tag)\s*>)
+  | (?P<tag><[a-zA-Z/!?](?:"[^"]*"|'[^']*'|[^'">])*>)
+''', re.DOTALL | re.IGNORECASE | re.VERBOSE)
+# MathJax's TeX delimiters (see mathjax.html), within which whitespace is left alone, as TeX comments run to the end
+# of the line
+MATH_RE = re.compile(r'\$\$.*?\$\$|\\\[.*?\\\]|\\\(.*?\\\)|\\begin\{([^}]*)\}.*?\\end\{\1\}', re.DOTALL)
+# Only the characters HTML treats as whitespace, which \s would go beyond (e.g. non-breaking spaces)
+WHITESPACE_RE = re.compile(r'[ \t\n\r\f]+')
+TAG_WHITESPACE_RE = re.compile(r'''("[^"]*"|'[^']*')|[ \t\n\r\f]+(/?>)?''')
+
+
+class HTMLMinifier(object):
+    """
+    Removes comments and collapses whitespace in built pages. Each run of
+    whitespace becomes a single newline if it contained one, or a single
+    space otherwise, so that the text renders as it did and line-sensitive
+    content such as inline TeX keeps working. The content of <pre>, <code>,
+    <textarea>, <script> and <style> elements and of MathJax's math
+    delimiters is kept exactly as it is, as are conditional comments.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.counts = Counter()
+
+    def process(self, html):
+        is_bytes = isinstance(html, bytes)
+        data = html if is_bytes else html.encode()
+
+        minified = minify_html(data.decode()).encode()
+        counts = self.counts if self.pid == os.getpid() else _worker_counts
+        counts.update(files=1, original=len(data), minified=len(minified))
+
+        return minified if is_bytes else minified.decode()
+
+    def add(self, counts):
+        self.counts.update(counts)
+
+    def finish(self):
+        original = self.counts['original']
+        minified = self.counts['minified']
+        logger.info('Minified %d files: %d bytes saved (%.1f%%)', self.counts['files'], original - minified,
+                    100 * (original - minified) / original if original else 0)
+
+
+def minify_html(html):
+    parts = []
+    position = 0
+    for match in TOKEN_RE.finditer(html):
+        parts.append(minify_text(html[position:match.start()]))
+        if match.group('comment'):
+            if match.group('comment').startswith(('<!--[if', '<!--<![endif]')):
+                parts.append(match.group('comment'))
+        elif match.group('raw'):
+            parts.append(match.group('raw'))
+        else:
+            parts.append(TAG_WHITESPACE_RE.sub(_minify_tag_whitespace, match.group('tag')))
+        position = match.end()
+    parts.append(minify_text(html[position:]))
+    return ''.join(parts)
+
+
+def minify_text(text):
+    if '\\' not in text and '$$' not in text:
+        return WHITESPACE_RE.sub(_collapse_whitespace, text)
+
+    parts = []
+    position = 0
+    for match in MATH_RE.finditer(text):
+        parts.append(WHITESPACE_RE.sub(_collapse_whitespace, text[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(WHITESPACE_RE.sub(_collapse_whitespace, text[position:]))
+    return ''.join(parts)
+
+
+def _collapse_whitespace(match):
+    return '\n' if '\n' in match.group(0) else ' '
+
+
+def _minify_tag_whitespace(match):
+    if match.group(1):
+        return match.group(1)
+    # Whitespace before the end of a tag can go entirely
+    return match.group(2) or ' '
+
+
+def get_minifier():
+    return _minifier
+
+
+def set_minifier(minifier):
+    global _minifier
+    _minifier = minifier
+
+
+def take_worker_counts():
+    counts = Counter(_worker_counts)
+    _worker_counts.clear()
+    return counts
+
+
+class MinifyOutputMixin(object):
+    """
+    Mixin for bakery views that minifies the HTML of each file they build,
+    if the build has it enabled.
+    """
+
+    def get_content(self, *args, **kwargs):
+        content = super().get_content(*args, **kwargs)
+        if _minifier is not None:
+            content = _minifier.process(content)
+        return content
@@ -1,16 +1,20 @@
 import datetime
-import itertools
+import logging
+import math
 import os
 import re
+from collections import Counter, defaultdict
 
 from bakery.feeds import BuildableFeed
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator
 from django.core.validators import FileExtensionValidator
 from django.db import models
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.http import Http404, HttpResponseRedirect, HttpResponsePermanentRedirect
+from django.template.loader import render_to_string
 from django.test import RequestFactory
 from django.utils.feedgenerator import Atom1Feed
 from django.utils.timezone import get_default_timezone, localtime
@@ -26,15 +30,30 @@ from wagtail.contrib.routable_page.models import RoutablePageMixin, route
 from wagtail.core.fields import StreamField
 from wagtail.core.models import Page
 from wagtail.core.url_routing import RouteResult
+from wagtail.images import get_image_model
 from wagtail.images.edit_handlers import ImageChooserPanel
+from wagtail.images.models import Filter
+from wagtail.images.shortcuts import get_rendition_or_not_found
 from wagtail.snippets.edit_handlers import SnippetChooserPanel
 from wagtail.snippets.models import register_snippet
 
 from .blocks import ContentBlock, ContentMethodsMixin
+from .build import get_manifest
+from .caches import BlogIndexCache, FragmentCache
+from .compression import CompressOutputMixin
+from .pagination import KeysetPaginator
+from .report import MeasureOutputMixin
+from .svg import get_optimized_name, store_optimized_svg, svg_data_uri
+from .writer import WriteBehindMixin
 
 
+logger = logging.getLogger(__name__)
+
 PAGINATION_REGEX = r'(?:page/(?P<page_num>[1-9]\d+|[2-9])/)?'
 
+# HeroImages loaded for the build in progress, if any, keyed by ID
+_hero_images = None
+
 
 class ResponseOverrideWrapper(object):
     """
@@ -146,9 +165,84 @@ class HeroImage(models.Model):
         ], heading='Display options'),
     ]
 
+    # Renditions of wagtail_image used by page.html, generated ahead of builds (see blog.renditions)
+    rendition_filters = ['original', 'original|format-webp']
+
     def __str__(self):
         return self.name
 
+    def get_rendition(self, filter_spec):
+        """
+        Returns a rendition of wagtail_image, preferring those loaded by
+        load_hero_images() to a query.
+        """
+
+        focal_point_key = Filter(filter_spec).get_cache_key(self.wagtail_image)
+        for rendition in getattr(self.wagtail_image, 'hero_renditions', []):
+            if rendition.filter_spec == filter_spec and rendition.focal_point_key == focal_point_key:
+                return rendition
+        return get_rendition_or_not_found(self.wagtail_image, filter_spec)
+
+    def original_rendition(self):
+        return self.get_rendition('original') if self.wagtail_image_id else None
+
+    def webp_rendition(self):
+        return self.get_rendition('original|format-webp') if self.wagtail_image_id else None
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._svg_srcs = {}
+        self.optimize_svgs()
+
+    def optimize_svgs(self):
+        """
+        Stores optimized copies of svg_image and svg_image_dark (see
+        blog.svg), if they're set. Files that can't be read are left as they
+        are, as get_svg_src() falls back to their URLs.
+        """
+
+        for field_file in (self.svg_image, self.svg_image_dark):
+            if field_file:
+                try:
+                    store_optimized_svg(field_file)
+                except OSError:
+                    logger.warning("Couldn't optimize SVG %s", field_file.name, exc_info=True)
+
+    def get_svg_src(self, field_file):
+        """
+        Returns the URL page.html uses for an SVG: a data URI if its optimized
+        copy is at most settings.HERO_SVG_INLINE_MAX_SIZE bytes, otherwise the
+        optimized copy's URL, falling back to the original's if there's no
+        optimized copy yet or the files can't be read.
+        """
+
+        if not field_file:
+            return None
+        if not hasattr(self, '_svg_srcs'):
+            self._svg_srcs = {}
+
+        if field_file.name not in self._svg_srcs:
+            storage = field_file.storage
+            name = get_optimized_name(field_file.name)
+            try:
+                if not storage.exists(name):
+                    name = field_file.name
+                if storage.size(name) <= settings.HERO_SVG_INLINE_MAX_SIZE:
+                    with storage.open(name, 'rb') as f:
+                        self._svg_srcs[field_file.name] = svg_data_uri(f.read())
+                else:
+                    self._svg_srcs[field_file.name] = storage.url(name)
+            except (OSError, UnicodeDecodeError):
+                logger.warning("Couldn't read SVG %s, so it won't be inlined", name, exc_info=True)
+                self._svg_srcs[field_file.name] = field_file.url
+        return self._svg_srcs[field_file.name]
+
+    def svg_src(self):
+        return self.get_svg_src(self.svg_image)
+
+    def svg_dark_src(self):
+        return self.get_svg_src(self.svg_image_dark)
+
     def clean(self):
         if not self.wagtail_image and not self.svg_image:
             raise ValidationError(_('Either a Wagtail image or SVG image is required.'))
@@ -158,13 +252,53 @@ class HeroImage(models.Model):
             raise ValidationError(_('Dark Wagtail/SVG images require a corresponding non-dark image'))
 
 
-class BlogPostFeed(BuildableFeed):
+def load_hero_images(ids=None):
+    """
+    Returns HeroImages (all of them, or those with the given IDs) keyed by ID,
+    loaded along with their Wagtail images and the renditions page.html uses
+    in two queries.
+    """
+
+    renditions = get_image_model().get_rendition_model().objects.filter(filter_spec__in=HeroImage.rendition_filters)
+    heroes = HeroImage.objects.select_related('wagtail_image').prefetch_related(
+        Prefetch('wagtail_image__renditions', queryset=renditions, to_attr='hero_renditions'))
+    if ids is not None:
+        heroes = heroes.filter(id__in=ids)
+    return {hero.id: hero for hero in heroes}
+
+
+def get_hero_images():
+    return _hero_images
+
+
+def set_hero_images(hero_images):
+    global _hero_images
+    _hero_images = hero_images
+
+
+class BlogPostFeed(MeasureOutputMixin, CompressOutputMixin, WriteBehindMixin, BuildableFeed):
     feed_type = Atom1Feed
 
+    # IDs of the indexes to build feeds for, if not all of them (see blog.rebuild)
+    index_ids = None
+
     # Shenanigans to get BuildableFeed to support multiple feed subjects
 
     def get_queryset(self):
-        return BlogIndex.objects.all().public()
+        indexes = BlogIndex.objects.all().public()
+        if self.index_ids is not None:
+            indexes = indexes.filter(id__in=self.index_ids)
+
+        manifest = get_manifest()
+        if manifest is None:
+            return indexes
+
+        return [obj for obj in indexes
+                if manifest.needs_build(self, os.path.join(settings.BUILD_DIR, self.build_path(obj)),
+                                        self.get_build_dependencies(obj, manifest.state))]
+
+    def get_build_dependencies(self, obj, state):
+        return state.dependencies(obj.id, *state.archive_posts(obj.id, 'all_posts', {})[:10])
 
     def build_path(self, obj):
         return os.path.join(self.feed_url(obj)[1:], 'atom.xml')
@@ -200,12 +334,8 @@ class BlogPostFeed(BuildableFeed):
     def item_title(self, item):
         return item.title
 
-    description_template = 'stream_nowrappers.html'
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['stream'] = kwargs['item'].body
-        return context
+    def item_description(self, item):
+        return item.render_body()
 
     def item_link(self, item):
         return item.url
@@ -232,8 +362,73 @@ class BasePage(Page):
         SnippetChooserPanel('hero_image')
     ]
 
+    def get_hero(self):
+        """
+        Returns this page's HeroImage as loaded by load_hero_images(), from the
+        build's cache during builds so that each is only loaded once.
+        """
+
+        if self.hero_image_id is None:
+            return None
+        if _hero_images is not None and self.hero_image_id in _hero_images:
+            return _hero_images[self.hero_image_id]
+
+        if getattr(self, '_hero', None) is None or self._hero.id != self.hero_image_id:
+            self._hero = load_hero_images([self.hero_image_id]).get(self.hero_image_id)
+        return self._hero
+
+
+class ContentFlagsMixin(ContentMethodsMixin, models.Model):
+    """
+    Stores facts about the page body that templates need, computed when the
+    page is saved, so that rendering a page or a listing of pages doesn't
+    have to walk every block of the body.
+    """
+
+    has_math = models.BooleanField(default=False, editable=False)
+    has_code = models.BooleanField(default=False, editable=False)
+    first_text_block_index = models.PositiveIntegerField(null=True, editable=False)
+    first_text_block_has_math = models.BooleanField(default=False, editable=False)
+    block_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.update_content_flags()
+        return super().save(*args, **kwargs)
+
+    def serve_preview(self, request, mode_name):
+        # Previews are rendered from unsaved pages
+        self.update_content_flags()
+        return super().serve_preview(request, mode_name)
 
-class AboutPage(BasePage, ContentMethodsMixin):
+    def update_content_flags(self):
+        first_block = super().first_text_block()
+
+        self.has_math = super().contains_math()
+        self.has_code = super().contains_code()
+        self.first_text_block_index = next((i for i, block in enumerate(self.content_field) if block is first_block),
+                                           None)
+        self.first_text_block_has_math = first_block is not None and self.block_contains_math(first_block)
+        self.block_count = len(self.content_field)
+
+    def first_text_block(self):
+        if self.first_text_block_index is None:
+            return None
+        return self.content_field[self.first_text_block_index]
+
+    def first_text_block_is_all_there_is(self):
+        return (self.block_count - int(self.first_text_block_index is not None)) == 0
+
+    def contains_math(self):
+        return self.has_math
+
+    def contains_code(self):
+        return self.has_code
+
+
+class AboutPage(ContentFlagsMixin, BasePage):
     body = StreamField(ContentBlock())
 
     content_panels = BasePage.content_panels + [
@@ -248,14 +443,12 @@ class BlogIndex(RoutablePageMixin, BasePage):
     @route('^' + PAGINATION_REGEX + '$')
     def all_posts(self, request, page_num=None):
         page_num = page_num and int(page_num)
-        return self.paginate(request, posts=self.public_posts(),
-                             view_name='all_posts', view_kwargs={'page_num': page_num}, title=self.title)
+        return self.paginate(request, view_name='all_posts', view_kwargs={'page_num': page_num}, title=self.title)
 
     @route(r'^tag/(?P<tag>[a-zA-Z0-9_-]+)/' + PAGINATION_REGEX + '$')
     def posts_by_tag(self, request, tag, page_num=None):
         page_num = page_num and int(page_num)
-        return self.paginate(request, posts=self.public_posts().filter(tags__name=tag),
-                             view_name='posts_by_tag', view_kwargs={'tag': tag, 'page_num': page_num},
+        return self.paginate(request, view_name='posts_by_tag', view_kwargs={'tag': tag, 'page_num': page_num},
                              title='Posts tagged "{}"'.format(tag), hero_title='#{}'.format(tag))
 
     @route(r'^(?P<year>[1-9]\d*)/' + PAGINATION_REGEX + '$')
@@ -267,13 +460,11 @@ class BlogIndex(RoutablePageMixin, BasePage):
         page_num = page_num and int(page_num)
 
         if month is None:
-            posts = self.public_posts().filter(pub_date__year=year)
             title = year
         else:
-            posts = self.public_posts().filter(pub_date__year=year, pub_date__month=month)
             title = datetime.date(year, month, 1).strftime('%B %Y')
 
-        return self.paginate(request, title=title, posts=posts,
+        return self.paginate(request, title=title,
                              view_name='posts_by_date',
                              view_kwargs={'year': year, 'month': month, 'page_num': page_num})
 
@@ -281,19 +472,51 @@ class BlogIndex(RoutablePageMixin, BasePage):
     def feed(self, request):
         return self.feed_view(request, blog_index=self)
 
-    def paginate(self, request, posts, view_name, view_kwargs=None, **kwargs):
-        paginator = Paginator(posts.specific().order_by('-pub_date', '-id'), self.posts_per_pagination_page)
+    def archive_posts(self, view_name, tag=None, year=None, month=None, **kwargs):
+        """
+        Returns the public posts listed by the given route.
+        """
+
+        posts = self.public_posts()
+        if view_name == 'posts_by_tag':
+            posts = posts.filter(tags__name=tag)
+        elif view_name == 'posts_by_date':
+            posts = posts.filter(pub_date__year=year)
+            if month is not None:
+                posts = posts.filter(pub_date__month=month)
+        return posts
+
+    def paginate(self, request, view_name, view_kwargs=None, **kwargs):
         view_kwargs = {k: v for k, v in view_kwargs.items() if v is not None}
         page_num = view_kwargs.get('page_num', 1)
 
-        if page_num > paginator.num_pages:
-            if paginator.num_pages > 1:
-                view_kwargs['page_num'] = paginator.num_pages
+        # Out of range pages redirect to the last page, which only needs the post count
+        count = self.archive_counts().count(view_name, **view_kwargs)
+        num_pages = max(1, math.ceil(count / self.posts_per_pagination_page))
+        if page_num > num_pages:
+            if num_pages > 1:
+                view_kwargs['page_num'] = num_pages
             else:
                 del view_kwargs['page_num']
             return HttpResponseRedirect(self.url + self.reverse_subpage(view_name, kwargs=view_kwargs))
 
-        page = paginator.page(page_num)
+        if view_name == 'posts_by_tag':
+            # Page through the tag's posts from the archive counts, rather than joining the tags for every page
+            paginator = Paginator(self.archive_counts().tag_posts.get(view_kwargs['tag'], []),
+                                  self.posts_per_pagination_page)
+            page = paginator.page(page_num)
+            page.object_list = self.get_posts(page.object_list)
+        else:
+            posts = self.archive_posts(view_name, **view_kwargs).specific().order_by('-pub_date', '-id')
+            if count:
+                archive_kwargs = tuple(sorted((k, v) for k, v in view_kwargs.items() if k != 'page_num'))
+                boundaries = archive_boundaries.get(self.path, view_name, archive_kwargs)
+            else:
+                # Empty archives (e.g. years without posts, which any URL can name) aren't worth caching
+                boundaries = (0, [])
+            paginator = KeysetPaginator(posts, self.posts_per_pagination_page, boundaries)
+            page = paginator.page(page_num)
+
         prev_url = next_url = None
 
         if page.has_previous():
@@ -315,12 +538,8 @@ class BlogIndex(RoutablePageMixin, BasePage):
         posts = kwargs['posts']
         full_posts = context.get('full_posts', False)
 
-        def limit(blocks):
-            return blocks if full_posts else itertools.islice(blocks, 1)
-
-        context['includes_math'] = any(post.block_contains_math(block)
-                                       for post in posts
-                                       for block in limit(post.all_text_blocks()))
+        context['includes_math'] = any(post.has_math if full_posts else post.first_text_block_has_math
+                                       for post in posts)
 
         context.update(kwargs)
 
@@ -332,6 +551,20 @@ class BlogIndex(RoutablePageMixin, BasePage):
     def public_posts(self):
         return self.posts().live().public()
 
+    def get_posts(self, ids):
+        """
+        Returns the public posts with the given IDs, in the same order.
+        """
+
+        posts = self.public_posts().in_bulk(ids)
+        return [posts[post_id] for post_id in ids if post_id in posts]
+
+    def archive_counts(self):
+        return archive_counts.get(self.path)
+
+    def route_index(self):
+        return route_index.get(self.path)
+
     def route(self, request, path_components):
         """
         Kludge to insert the publication year and month into BlogPost URLs.
@@ -346,48 +579,143 @@ class BlogIndex(RoutablePageMixin, BasePage):
             year, month, child_slug = path_components[:3]
             remaining_components = path_components[3:]
 
-            if re.match(r'^\d+$', year) and re.match(r'^\d{2}$', month):
+            if re.match(r'^\d+$', year) and re.match(r'^\d{2}$', month) and child_slug in self.route_index():
+                post_id, live, post_year, post_month = self.route_index()[child_slug]
+
+                # 404 if the post hasn't been published
+                if not live:
+                    raise Http404
+
                 try:
-                    post = self.posts().get(slug=child_slug).specific
-                except Page.DoesNotExist:
-                    pass
-                else:
-                    # 404 if the post hasn't been published
-                    if not post.live:
-                        raise Http404
+                    post = BlogPost.objects.get(id=post_id)
+                except BlogPost.DoesNotExist:
+                    raise Http404
 
-                    # Redirect to the canonical url if the request included incorrect dates
-                    if str(post.pub_date_norm.year) != year or '{:02}'.format(post.pub_date_norm.month) != month:
-                        canonical_post_url = post.url
-                        if remaining_components:
-                            canonical_post_url += '/'.join(remaining_components) + '/'
+                # Redirect to the canonical url if the request included incorrect dates
+                if str(post_year) != year or '{:02}'.format(post_month) != month:
+                    canonical_post_url = post.url
+                    if remaining_components:
+                        canonical_post_url += '/'.join(remaining_components) + '/'
 
-                        response = HttpResponsePermanentRedirect(canonical_post_url)
-                        return RouteResult(ResponseOverrideWrapper(post, response))
+                    response = HttpResponsePermanentRedirect(canonical_post_url)
+                    return RouteResult(ResponseOverrideWrapper(post, response))
 
-                    # Otherwise, delegate routing to the post
-                    return post.route(request, remaining_components)
+                # Otherwise, delegate routing to the post
+                return post.route(request, remaining_components)
 
         # Handle paths of the form slug/ - matching blog posts shouldn't be accessible this way
-        if len(path_components) > 0:
-            child_slug = path_components[0]
-
-            try:
-                self.posts().get(slug=child_slug)
-            except Page.DoesNotExist:
-                pass
-            else:
-                raise Http404
+        if len(path_components) > 0 and path_components[0] in self.route_index():
+            raise Http404
 
         # For all other paths, defer to existing routing
         return super().route(request, path_components)
 
 
+def get_archive_boundaries(path, view_name, archive_kwargs):
+    """
+    Returns the post count and page boundaries of a BlogIndex route for
+    KeysetPaginator, computed in one pass over the keys of its posts.
+    """
+
+    blog_index = BlogIndex.objects.get(path=path)
+    keys = (blog_index.archive_posts(view_name, **dict(archive_kwargs))
+            .order_by('-pub_date', '-id').values_list('pub_date', 'pk'))
+    return KeysetPaginator.get_boundaries(keys, blog_index.posts_per_pagination_page)
+
+
+archive_boundaries = BlogIndexCache(get_archive_boundaries, max_size=1024)
+
+
+class ArchiveCounts(object):
+    """
+    Public post counts of a BlogIndex, in total and per tag, year and month,
+    plus the IDs of each tag's posts.
+
+    Takes one (post ID, pub_date, tag name, tag slug) row per tag of each
+    post, newest first, with None tags for untagged posts, so that it all
+    comes from a single pass over a single query.
+    """
+
+    def __init__(self, rows):
+        self.total = 0
+        self.tags = Counter()
+        self.tag_slugs = {}
+        self.tag_posts = defaultdict(list)
+        self.years = Counter()
+        self.months = Counter()
+
+        seen = set()
+        for post_id, pub_date, tag_name, tag_slug in rows:
+            if tag_name is not None:
+                self.tags[tag_name] += 1
+                self.tag_slugs[tag_name] = tag_slug
+                self.tag_posts[tag_name].append(post_id)
+            if post_id not in seen:
+                seen.add(post_id)
+                pub_date = localtime(pub_date)
+                self.total += 1
+                self.years[pub_date.year] += 1
+                self.months[pub_date.year, pub_date.month] += 1
+
+    def count(self, view_name, tag=None, year=None, month=None, **kwargs):
+        """
+        Returns the number of posts listed by the given route.
+        """
+
+        if view_name == 'posts_by_tag':
+            return self.tags[tag]
+        elif view_name == 'posts_by_date':
+            return self.years[year] if month is None else self.months[year, month]
+        return self.total
+
+
+def get_archive_counts(path):
+    rows = (BlogIndex.objects.get(path=path).public_posts().order_by('-pub_date', '-id')
+            .values_list('id', 'pub_date', 'tagged_items__tag__name', 'tagged_items__tag__slug'))
+    return ArchiveCounts(rows)
+
+
+archive_counts = BlogIndexCache(get_archive_counts)
+
+
+def get_route_index(path):
+    """
+    Maps the slug of every post under the BlogIndex at the given tree path,
+    published or not, to its ID, live status and canonical publication year
+    and month, so that most requests can be routed without queries.
+    """
+
+    index = {}
+    for slug, post_id, live, pub_date in BlogIndex.objects.get(path=path).posts().values_list('slug', 'id', 'live',
+                                                                                                'pub_date'):
+        pub_date = localtime(pub_date, get_default_timezone())
+        index[slug] = (post_id, live, pub_date.year, pub_date.month)
+    return index
+
+
+route_index = BlogIndexCache(get_route_index)
+
+
+def get_neighbour_index(path):
+    """
+    Returns the public posts of the BlogIndex at the given tree path ordered
+    by (pub_date, id), plus a map from post ID to position in that order.
+    """
+
+    posts = list(BlogIndex.objects.get(path=path).public_posts().order_by('pub_date', 'id').defer('body'))
+    return posts, {post.id: position for position, post in enumerate(posts)}
+
+
+neighbour_index = BlogIndexCache(get_neighbour_index)
+
+post_fragments = FragmentCache()
+
+
 class BlogPostTag(TaggedItemBase):
     content_object = ParentalKey('blog.BlogPost', related_name='tagged_items')
 
 
-class BlogPost(BasePage, ContentMethodsMixin):
+class BlogPost(ContentFlagsMixin, BasePage):
     parent_page_types = ['blog.BlogIndex']
 
     pub_date = models.DateTimeField(verbose_name='Publication date')
@@ -403,6 +731,10 @@ class BlogPost(BasePage, ContentMethodsMixin):
         FieldPanel('tags')
     ]
 
+    class Meta:
+        # Supports the range conditions of KeysetPaginator
+        indexes = [models.Index(fields=['pub_date', 'basepage_ptr'])]
+
     def set_url_path(self, parent):
         """
         Adds the publication year and month into this page's recorded URL.
@@ -419,7 +751,49 @@ class BlogPost(BasePage, ContentMethodsMixin):
     def pub_date_norm(self):
         return localtime(self.pub_date, get_default_timezone())
 
+    def render_summary(self, request=None, full_posts=False):
+        """
+        Returns the markup listing this post on BlogIndex pages, which is
+        reused across every listing the post appears on.
+        """
+
+        return post_fragments.get(self, 'full' if full_posts else 'summary', lambda: render_to_string(
+            'blog/post_summary.html', {'post': self, 'full_posts': full_posts}, request))
+
+    def render_body(self):
+        """
+        Returns the markup of this post's body, as included in feeds.
+        """
+
+        return post_fragments.get(self, 'body', lambda: render_to_string('stream_nowrappers.html',
+                                                                         {'stream': self.body}))
+
     def prev_post(self):
+        return self.neighbours()[0]
+
+    def next_post(self):
+        return self.neighbours()[1]
+
+    def neighbours(self):
+        """
+        Returns the previous and next public posts, memoized as templates
+        tend to ask for each of them more than once.
+        """
+
+        if not hasattr(self, '_neighbours'):
+            posts, positions = neighbour_index.get(self.path[:-self.steplen]) if self.id else ([], {})
+            position = positions.get(self.id)
+
+            # Previews may show a post that isn't saved, isn't published or has a different date
+            if position is None or posts[position].pub_date != self.pub_date:
+                self._neighbours = self.query_prev_post(), self.query_next_post()
+            else:
+                self._neighbours = (posts[position - 1] if position > 0 else None,
+                                    posts[position + 1] if position + 1 < len(posts) else None)
+
+        return self._neighbours
+
+    def query_prev_post(self):
         q = Q(pub_date__lt=self.pub_date)
         if self.id:
             q |= Q(pub_date__lte=self.pub_date) & Q(id__lt=self.id)
@@ -429,7 +803,7 @@ class BlogPost(BasePage, ContentMethodsMixin):
                 .order_by('-pub_date', '-id')
                 .specific().first())
 
-    def next_post(self):
+    def query_next_post(self):
         q = Q(pub_date__gt=self.pub_date)
         if self.id:
             q |= Q(pub_date__gte=self.pub_date) & Q(id__gt=self.id)
@@ -0,0 +1,29 @@
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator for posts ordered by (-pub_date, -id), which fetches each page
+    with a range condition on those keys rather than an OFFSET. It's given
+    the number of posts and the key of the first post on each page, which
+    get_boundaries() finds in one pass over the keys.
+    """
+
+    def __init__(self, object_list, per_page, boundaries):
+        super().__init__(object_list, per_page)
+        self.count, self.boundaries = boundaries
+
+    @staticmethod
+    def get_boundaries(keys, per_page):
+        keys = list(keys)
+        return len(keys), keys[::per_page]
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.boundaries:
+            return self._get_page([], number, self)
+
+        pub_date, pk = self.boundaries[number - 1]
+        posts = self.object_list.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lte=pk))
+        return self._get_page(posts[:self.per_page], number, self)
@@ -0,0 +1,284 @@
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_callable
+from django.utils.timezone import localtime
+
+from wagtail.core.models import Page
+
+from .build import BuildManifest, ParallelBuildMixin, build_lock, get_view_path, set_manifest, sync_tree
+from .compression import Compressor, set_compressor
+from .critical_css import CriticalCSS, set_critical_css
+from .minify import HTMLMinifier, set_minifier
+from .models import BlogIndex, BlogPost, BlogPostFeed
+from .search import SearchIndexView
+from .views import BlogIndexView, OtherPagesView, SitemapView
+from .writer import OutputWriter, set_writer
+
+
+logger = logging.getLogger(__name__)
+
+
+class LiveRebuilder(object):
+    """
+    Rebuilds the files affected by pages published or unpublished in the
+    admin (see blog.signals), in a background thread so that editors don't
+    wait for it. Each change restarts a timer of settings.LIVE_REBUILD_DELAY
+    seconds, so that a burst of edits leads to a single rebuild.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.run_lock = threading.Lock()
+        self.page_ids = set()
+        self.timer = None
+
+    def schedule(self, page_id):
+        with self.lock:
+            self.page_ids.add(page_id)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(settings.LIVE_REBUILD_DELAY, self.run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def run(self):
+        # Rebuilds share the build globals, so they mustn't overlap
+        with self.run_lock:
+            with self.lock:
+                page_ids, self.page_ids = self.page_ids, set()
+                if self.timer is threading.current_thread():
+                    self.timer = None
+
+            if not page_ids:
+                return
+            try:
+                rebuild_pages(page_ids)
+            except Exception:
+                logger.exception('Failed to rebuild pages %s', ', '.join(str(page_id) for page_id in sorted(page_ids)))
+            finally:
+                connections.close_all()
+
+
+live_rebuilder = LiveRebuilder()
+
+
+def rebuild_pages(page_ids):
+    """
+    Rebuilds the files affected by changes to the given pages, on top of a
+    previous build and with the same options. Files whose dependencies turn
+    out to be unchanged are skipped, as in incremental builds.
+    """
+
+    # Each of the server's processes has its own rebuilder, so they take turns through the build directory's lock
+    with build_lock(settings.BUILD_DIR):
+        _rebuild_pages(page_ids)
+
+
+def _rebuild_pages(page_ids):
+    manifest = BuildManifest(settings.BUILD_DIR, incremental=True)
+    if not manifest.previous_entries:
+        logger.warning("Not rebuilding pages %s, as there's no previous build to update",
+                       ', '.join(str(page_id) for page_id in sorted(page_ids)))
+        return
+
+    # Build with the options of the previous build, which are also part of the site's dependencies
+    options = manifest.options = manifest.previous_options
+    compressor = Compressor() if options.get('compression', True) else None
+    minifier = HTMLMinifier() if options.get('minify_html') else None
+    writer = OutputWriter()
+    set_manifest(manifest)
+    set_compressor(compressor)
+    set_critical_css(CriticalCSS() if options.get('critical_css') else None)
+    set_minifier(minifier)
+    set_writer(writer)
+    try:
+        if manifest.site_changed:
+            # Every page links to the site's other pages, so rebuild whatever is out of date
+            logger.info('Rebuilding the site, as its navigation has changed')
+            view_paths = settings.BAKERY_VIEWS
+            scope = None
+            for view_path in view_paths:
+                view = get_callable(view_path)()
+                if isinstance(view, ParallelBuildMixin):
+                    view.build_tasks(workers=1)
+                else:
+                    view.build_method()
+        else:
+            targets = AffectedFiles(manifest)
+            for page_id in page_ids:
+                targets.add_page(page_id)
+            logger.info('Rebuilding the files affected by pages %s',
+                        ', '.join(str(page_id) for page_id in sorted(page_ids)))
+
+            view_paths = [get_view_path(BlogIndexView), get_view_path(OtherPagesView), get_view_path(BlogPostFeed)]
+            scope = targets.scope
+            BlogIndexView().build_tasks(targets.index_tasks, workers=1)
+            OtherPagesView().build_tasks(targets.page_tasks, workers=1)
+            feed = BlogPostFeed()
+            feed.index_ids = targets.feed_index_ids
+            feed.build_method()
+            SitemapView().build()
+            SearchIndexView().build()
+    finally:
+        set_manifest(None)
+        set_compressor(None)
+        set_critical_css(None)
+        set_minifier(None)
+        set_writer(None)
+        writer.wait()
+    writer.finish()
+    manifest.finish(view_paths, scope=scope)
+    if compressor:
+        compressor.finish()
+    if minifier:
+        minifier.finish()
+
+    # Renditions used for the first time were generated while rendering
+    sync_media()
+
+
+class AffectedFiles(object):
+    """
+    Works out which files may have changed along with a page: those that
+    listed or linked to it in the previous build, going by the manifest, and
+    those that do now. For a post, that's the post itself, its neighbours,
+    every page of the listings it appears on and its index's feed.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.state = manifest.state
+        self.index_view = BlogIndexView()
+        self.page_view = OtherPagesView()
+
+        self.index_tasks = []
+        self.page_tasks = []
+        self.task_keys = set()
+        self.feed_index_ids = set()
+        # Relative paths of previously built files that may need removing
+        self.scope = set()
+
+    def previous_paths(self, page_id, view_class):
+        """
+        Returns the relative paths of the files of the given view that
+        depended on or linked to the page in the previous build.
+        """
+
+        view_path = get_view_path(view_class)
+        return {relative_path for relative_path, entry in self.manifest.previous_entries.items()
+                if entry['view'] == view_path and (
+                    str(page_id) in entry['dependencies'].get('pages', {}) or
+                    str(page_id) in entry['dependencies'].get('references', {}).get('pages', {}))}
+
+    def add_page(self, page_id):
+        page = Page.objects.get(id=page_id).specific
+        if isinstance(page, BlogPost):
+            self.add_post(page)
+        elif isinstance(page, BlogIndex):
+            self.add_index(page)
+        else:
+            self.add_pages([page_id])
+
+    def add_pages(self, page_ids):
+        """
+        Adds the pages with the given IDs, other than indexes, along with
+        those whose previously built files depended on them.
+        """
+
+        page_ids = set(page_ids)
+        for page_id in list(page_ids):
+            for relative_path in self.previous_paths(page_id, OtherPagesView):
+                self.scope.add(relative_path)
+                # The page the file belongs to is one of its dependencies
+                page_ids.update(int(dependency) for dependency in
+                                self.manifest.previous_entries[relative_path]['dependencies']['pages'])
+
+        pages = Page.objects.filter(id__in=page_ids).live().public().not_type(BlogIndex).specific()
+        for item in pages:
+            url = self.page_view.get_url(item)
+            if url is not None and (item.id, url) not in self.task_keys:
+                self.task_keys.add((item.id, url))
+                self.page_tasks.append((item.id, url))
+
+    def add_post(self, post):
+        index = BlogIndex.objects.filter(id=post.get_parent().id).first()
+        if index is None:
+            return
+
+        page_ids = [post.id]
+        if post.id in self.state.post_indexes:
+            page_ids.extend(page_id for page_id in self.state.neighbours(post.id) if page_id is not None)
+        self.add_pages(page_ids)
+
+        # Listings that contain the post now, and those that did before
+        listings = {('all_posts', ())}
+        if post.id in self.state.post_indexes:
+            pub_date = localtime(post.pub_date)
+            listings.add(('posts_by_date', (('year', pub_date.year),)))
+            listings.add(('posts_by_date', (('month', pub_date.month), ('year', pub_date.year))))
+            listings.update(('posts_by_tag', (('tag', tag),)) for tag in post.tags.values_list('slug', flat=True))
+        previous_paths = self.previous_paths(post.id, BlogIndexView)
+        self.add_listings(index, listings, previous_paths)
+
+        self.feed_index_ids.add(index.id)
+
+    def add_index(self, index):
+        self.add_listings(index, None, set())
+        self.add_pages([post_id for post_id, index_id in self.state.post_indexes.items() if index_id == index.id])
+        self.feed_index_ids.add(index.id)
+
+    def add_listings(self, index, listings, previous_paths):
+        """
+        Adds every page of the given listings of the index, or all of its
+        listings if listings is None, plus those of any previously built
+        files at the given paths. Pages past the end of a listing that were
+        built before are added to the scope, so that they're removed.
+        """
+
+        subpages = [(view_name, view_kwargs, self.relative_path(index, view_name, view_kwargs))
+                    for view_name, view_kwargs in self.index_view.get_subpages(index)]
+        if listings is not None:
+            listings = set(listings)
+            listings.update(listing_key(view_name, view_kwargs) for view_name, view_kwargs, relative_path
+                            in subpages if relative_path in previous_paths)
+
+        num_pages = {}
+        for view_name, view_kwargs, relative_path in subpages:
+            key = listing_key(view_name, view_kwargs)
+            if listings is not None and key not in listings:
+                continue
+            num_pages[key] = max(num_pages.get(key, 0), view_kwargs.get('page_num', 1))
+            if (index.id, relative_path) not in self.task_keys:
+                self.task_keys.add((index.id, relative_path))
+                self.index_tasks.append((index.id, view_name, view_kwargs))
+
+        self.scope |= previous_paths
+        for (view_name, kwargs), last_page in num_pages.items():
+            page_num = last_page + 1
+            while True:
+                relative_path = self.relative_path(index, view_name, dict(kwargs, page_num=page_num))
+                if relative_path not in self.manifest.previous_entries:
+                    break
+                self.scope.add(relative_path)
+                page_num += 1
+
+    def relative_path(self, index, view_name, view_kwargs):
+        return os.path.relpath(self.index_view.get_subpage_build_path(index, view_name, view_kwargs),
+                               settings.BUILD_DIR)
+
+
+def listing_key(view_name, view_kwargs):
+    return view_name, tuple(sorted((k, v) for k, v in view_kwargs.items() if k != 'page_num'))
+
+
+def sync_media():
+    """
+    Copies media files that are missing from the build directory, or have
+    changed, into it.
+    """
+
+    sync_tree(settings.MEDIA_ROOT, os.path.join(settings.BUILD_DIR, settings.MEDIA_URL.lstrip('/')))
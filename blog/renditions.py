@@ -0,0 +1,121 @@
+import logging
+from collections import defaultdict
+
+from django.apps import apps
+
+from wagtail.core.blocks import ListBlock, StreamBlock, StructBlock
+from wagtail.images import get_image_model
+from wagtail.images.blocks import ImageChooserBlock
+from wagtail.images.models import Filter
+
+from .blocks import ContentMethodsMixin
+from .build import run_build_tasks
+from .models import BasePage, HeroImage
+
+
+logger = logging.getLogger(__name__)
+
+
+class RenditionBuilder(object):
+    """
+    Generates image renditions ahead of a build, so that templates find them
+    already in the database rather than running Pillow mid-render. Used as
+    the "view" of run_build_tasks(), which spreads the work across the same
+    pool of worker processes as the pages.
+    """
+
+    def __init__(self):
+        self.images = {}
+
+    def build_task(self, task):
+        image_id, filter_spec = task
+        if image_id not in self.images:
+            self.images[image_id] = get_image_model().objects.get(id=image_id)
+        self.images[image_id].get_rendition(filter_spec)
+
+
+def build_renditions(workers=None):
+    """
+    Generates every missing rendition needed by the public pages of the site.
+    """
+
+    required = get_required_renditions()
+    tasks = sorted(get_missing_renditions(required))
+
+    total = sum(len(filter_specs) for filter_specs in required.values())
+    logger.info('Renditions: %d of %d up to date', total - len(tasks), total)
+    run_build_tasks(RenditionBuilder, tasks, workers=workers)
+
+
+def get_required_renditions():
+    """
+    Returns the filter specs of the renditions needed by the public pages of
+    the site, keyed by image ID. Stream content is walked in its raw form,
+    so no blocks are converted to Python values along the way.
+    """
+
+    required = defaultdict(set)
+
+    for model in apps.get_app_config('blog').get_models():
+        if not issubclass(model, ContentMethodsMixin):
+            continue
+        stream_block = model._meta.get_field(model.content_field_name).stream_block
+        for stream in model.objects.live().public().values_list(model.content_field_name, flat=True):
+            find_images(stream_block, stream.raw_data, [], required)
+
+    heroes = BasePage.objects.live().public().filter(hero_image__wagtail_image__isnull=False)
+    for image_id in heroes.values_list('hero_image__wagtail_image', flat=True).distinct():
+        required[image_id].update(HeroImage.rendition_filters)
+
+    return required
+
+
+def find_images(block, value, filters, required):
+    """
+    Adds the images in the given raw block value to required, with the
+    rendition filters of the closest enclosing block that declares any.
+    """
+
+    if value is None:
+        return
+    filters = getattr(block.meta, 'rendition_filters', filters)
+
+    if isinstance(block, ImageChooserBlock):
+        if filters:
+            required[value].update(filters)
+    elif isinstance(block, StreamBlock):
+        for child in value:
+            child_block = block.child_blocks.get(child['type'])
+            if child_block is not None:
+                find_images(child_block, child['value'], filters, required)
+    elif isinstance(block, StructBlock):
+        for name, child_block in block.child_blocks.items():
+            find_images(child_block, value.get(name), filters, required)
+    elif isinstance(block, ListBlock):
+        for item in value:
+            # List items may or may not be wrapped with a type and ID, depending on when they were saved
+            if isinstance(item, dict) and item.get('type') == 'item' and 'id' in item:
+                item = item['value']
+            find_images(block.child_block, item, filters, required)
+
+
+def get_missing_renditions(required):
+    """
+    Yields the (image ID, filter spec) pairs in required that don't have a
+    rendition yet.
+    """
+
+    image_model = get_image_model()
+    images = image_model.objects.in_bulk(required.keys())
+
+    existing = set(image_model.get_rendition_model().objects.filter(image__in=images.keys())
+                   .values_list('image', 'filter_spec', 'focal_point_key'))
+
+    for image_id, filter_specs in required.items():
+        image = images.get(image_id)
+        if image is None:
+            # Deleted images are skipped by the templates too
+            continue
+        for filter_spec in filter_specs:
+            if (image_id, filter_spec, Filter(filter_spec).get_cache_key(image)) not in existing:
+                yield image_id, filter_spec
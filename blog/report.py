@@ -0,0 +1,162 @@
+import csv
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+# The report of the build in progress, if any
+_report = None
+
+# The measurements of the file being built by this process, if any
+_current = None
+
+# Files built by this process since the last call to take_records()
+_records = []
+
+
+class BuildReport(object):
+    """
+    Collects the wall time, query count, DB time, render time and size of
+    every file built by views using MeasureOutputMixin, whether they're built
+    by this process or by worker processes (see blog.build).
+
+    Render time is the time spent producing a file's content, including any
+    queries made along the way; wall time also includes setting up the
+    request beforehand and writing the file afterwards.
+    """
+
+    fields = ['path', 'view', 'wall_time', 'queries', 'db_time', 'render_time', 'bytes']
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, records):
+        self.records.extend(records)
+
+    def write(self, path):
+        """
+        Writes the report as CSV if the path ends with .csv, or JSON otherwise.
+        """
+
+        records = sorted(self.records, key=lambda record: record['path'])
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, self.fields)
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                json.dump(records, f, indent=4)
+                f.write('\n')
+
+    def log_summary(self, top):
+        total = sum(record['wall_time'] for record in self.records)
+        logger.info('Built %d files taking %.2fs in total (%d queries, %.2fs in the database)',
+                    len(self.records), total, sum(record['queries'] for record in self.records),
+                    sum(record['db_time'] for record in self.records))
+
+        if top:
+            logger.info('Slowest files:')
+            for record in sorted(self.records, key=lambda record: record['wall_time'], reverse=True)[:top]:
+                logger.info('  %s: %.3fs, %d queries (%.3fs), rendered in %.3fs, %d bytes', record['path'],
+                            record['wall_time'], record['queries'], record['db_time'], record['render_time'],
+                            record['bytes'])
+
+    def over_budget(self, query_budget):
+        """
+        Returns the records of files that took more than the given number of
+        queries to build, most queries first.
+        """
+
+        return sorted((record for record in self.records if record['queries'] > query_budget),
+                      key=lambda record: record['queries'], reverse=True)
+
+
+def get_report():
+    return _report
+
+
+def set_report(report):
+    """
+    Starts or stops measuring built files. Worker processes forked while a
+    report is set measure their files too, as they inherit the query counter.
+    """
+
+    global _report
+
+    if report is not None and _report is None:
+        connection.execute_wrappers.append(count_queries)
+    elif report is None and _report is not None:
+        connection.execute_wrappers.remove(count_queries)
+    _report = report
+
+
+def count_queries(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if _current is not None:
+            _current['queries'] += 1
+            _current['db_time'] += time.perf_counter() - start
+
+
+def begin_output(restart=False):
+    """
+    Starts measuring the next file built by this process, unless a
+    measurement is already under way and restart is false.
+    """
+
+    global _current
+    if _report is not None and (restart or _current is None):
+        _current = {'start': time.perf_counter(), 'queries': 0, 'db_time': 0.0, 'render_time': 0.0}
+
+
+def end_output(view=None, path=None, data=b''):
+    """
+    Finishes measuring the file at the given path, or discards the
+    measurement under way if no path is given.
+    """
+
+    global _current
+    if _current is not None and path is not None:
+        _records.append({
+            'path': os.path.relpath(path, settings.BUILD_DIR),
+            'view': '{0.__module__}.{0.__qualname__}'.format(type(view)),
+            'wall_time': time.perf_counter() - _current['start'],
+            'queries': _current['queries'],
+            'db_time': _current['db_time'],
+            'render_time': _current['render_time'],
+            'bytes': len(data),
+        })
+    _current = None
+
+
+def take_records():
+    records = list(_records)
+    del _records[:]
+    return records
+
+
+class MeasureOutputMixin(object):
+    """
+    Mixin for bakery views that adds each file they build to the build
+    report, if there is one.
+    """
+
+    def get_content(self, *args, **kwargs):
+        begin_output()
+        start = time.perf_counter()
+        content = super().get_content(*args, **kwargs)
+        if _current is not None:
+            _current['render_time'] += time.perf_counter() - start
+        return content
+
+    def build_file(self, path, html):
+        super().build_file(path, html)
+        end_output(self, path, html)
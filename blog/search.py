@@ -0,0 +1,193 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from html import unescape
+
+from django.conf import settings
+from django.utils.html import strip_tags
+
+from wagtail.core.blocks import RichTextBlock
+
+from .compression import compress_output
+from .models import BlogPost
+from .writer import write_file_atomic
+
+
+logger = logging.getLogger(__name__)
+
+# Words too common to be worth indexing, which the client leaves out of queries too
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'if', 'in', 'into', 'is',
+    'it', 'its', 'no', 'not', 'of', 'on', 'or', 'so', 'such', 'that', 'the', 'their', 'then', 'there', 'these',
+    'they', 'this', 'to', 'was', 'were', 'will', 'with',
+])
+# Letters, digits and underscores, matched by the client as [\p{L}\p{N}_]+
+WORD_RE = re.compile(r'\w+')
+SHARD_KEY_RE = re.compile(r'[^a-z0-9]')
+
+# How much an occurrence of a term in each field counts towards a post's score
+FIELD_WEIGHTS = {'title': 8, 'tags': 4, 'body': 1}
+
+
+def tokenize(text):
+    """
+    Returns the terms in the given text: lowercase words of at least
+    SearchIndexView.prefix_length characters, with accents removed, minus
+    stop words. static/js/search.js does the same to queries.
+    """
+
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text.lower())
+                   if not unicodedata.category(char).startswith('M'))
+    return [word for word in WORD_RE.findall(text)
+            if len(word) >= SearchIndexView.prefix_length and word not in STOP_WORDS]
+
+
+def shard_key(term):
+    return SHARD_KEY_RE.sub('_', term[:SearchIndexView.prefix_length])
+
+
+def get_post_terms(post):
+    """
+    Returns the weighted terms of a post's title, tags and the plain text of
+    its rich text blocks.
+    """
+
+    terms = Counter()
+    fields = [('title', post.title), ('tags', ' '.join(tag.name for tag in post.tags.all()))]
+    for child in post.body.raw_data:
+        if isinstance(post.body.stream_block.child_blocks.get(child['type']), RichTextBlock):
+            fields.append(('body', unescape(strip_tags(child['value']))))
+
+    for field, text in fields:
+        for term in tokenize(text):
+            terms[term] += FIELD_WEIGHTS[field]
+    return dict(terms)
+
+
+class SearchIndexView(object):
+    """
+    Builds a search index of the public posts for the built site's client
+    (static/js/search.js), under search/ in the build directory:
+
+    - index.json lists the shards and the stop words, with a hash of each
+      file for cache busting.
+    - docs.json has the URL, title and date of each post.
+    - <prefix>.json maps each term starting with the prefix (its first
+      prefix_length characters, with anything outside a-z and 0-9 replaced
+      by "_") to the IDs and scores of the posts containing it, best first.
+
+    The terms of each post are kept between builds next to the build
+    directory, so only posts published since the previous build are
+    re-indexed, and only shards whose content changed are rewritten.
+    """
+
+    version = 1
+    directory = 'search'
+    prefix_length = 2
+
+    def __init__(self):
+        self.output_dir = os.path.join(settings.BUILD_DIR, self.directory)
+        self.path = settings.BUILD_DIR.rstrip(os.sep) + '-search.json'
+
+    @property
+    def build_method(self):
+        return self.build
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if data.get('version') != self.version or data.get('build_dir') != settings.BUILD_DIR:
+            return {}
+        return data['posts']
+
+    def save(self, posts):
+        data = {'version': self.version, 'build_dir': settings.BUILD_DIR, 'posts': posts}
+        write_file_atomic(self.path, json.dumps(data, sort_keys=True))
+
+    def build(self):
+        previous = self.load()
+        posts = {}
+        docs = []
+        stale_ids = []
+
+        queryset = BlogPost.objects.live().public().defer_streamfields().order_by('-pub_date', '-id')
+        for post in queryset:
+            last_published = post.last_published_at.isoformat() if post.last_published_at else None
+            entry = previous.get(str(post.id))
+            if entry is not None and entry['last_published'] == last_published:
+                posts[str(post.id)] = entry
+            else:
+                posts[str(post.id)] = {'last_published': last_published, 'terms': None}
+                stale_ids.append(post.id)
+            docs.append([post.id, post.url, post.title, post.pub_date_norm.date().isoformat()])
+
+        for post in BlogPost.objects.filter(id__in=stale_ids).prefetch_related('tags'):
+            posts[str(post.id)]['terms'] = get_post_terms(post)
+
+        shards = defaultdict(lambda: defaultdict(list))
+        for post_id, entry in posts.items():
+            for term, score in entry['terms'].items():
+                shards[shard_key(term)][term].append([int(post_id), score])
+        for shard in shards.values():
+            for postings in shard.values():
+                postings.sort(key=lambda posting: (-posting[1], posting[0]))
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = 0
+        hashes = {}
+        for key, shard in shards.items():
+            hashes[key], changed = self.write_json('{}.json'.format(key), shard)
+            written += changed
+        docs_hash, changed = self.write_json('docs.json', docs)
+        written += changed
+        self.write_json('index.json', {
+            'prefix_length': self.prefix_length,
+            'stop_words': sorted(STOP_WORDS),
+            'docs': docs_hash,
+            'shards': hashes,
+        })
+        self.remove_stale_shards(hashes)
+
+        self.save(posts)
+        logger.info('Search index: %d posts (%d re-indexed), %d terms in %d shards (%d files written)',
+                    len(posts), len(stale_ids), sum(len(shard) for shard in shards.values()), len(shards), written)
+
+    def write_json(self, name, value):
+        """
+        Writes a file of the index, unless it's unchanged, and returns a
+        short hash of its content and whether it was written.
+        """
+
+        data = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+        path = os.path.join(self.output_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                changed = f.read() != data
+        except OSError:
+            changed = True
+
+        if changed:
+            write_file_atomic(path, data)
+            compress_output(path, data)
+        return hashlib.sha1(data).hexdigest()[:12], changed
+
+    def remove_stale_shards(self, hashes):
+        """
+        Removes shards of a previous build whose terms are gone, along with
+        their precompressed siblings.
+        """
+
+        files = {'index.json', 'docs.json'} | {'{}.json'.format(key) for key in hashes}
+        for path in glob.glob(os.path.join(self.output_dir, '*.json*')):
+            name = os.path.basename(path)
+            if name not in files and os.path.splitext(name)[0] not in files:
+                os.remove(path)
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from wagtail.core.models import Page, PageViewRestriction
+from wagtail.core.signals import page_published, page_unpublished, post_page_move
+from wagtail.documents import get_document_model
+from wagtail.images import get_image_model
+
+from .blocks import block_render_cache
+from .caches import BlogIndexCache
+from .models import post_fragments
+from .rebuild import live_rebuilder
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+@receiver(post_page_move)
+def invalidate_on_page_change(sender, **kwargs):
+    BlogIndexCache.invalidate()
+    block_render_cache.invalidate_references()
+    post_fragments.invalidate_references()
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def schedule_live_rebuild(sender, instance, **kwargs):
+    if settings.LIVE_REBUILD:
+        # The rebuild reads the page back from the database, so wait until the change is committed
+        transaction.on_commit(lambda: live_rebuilder.schedule(instance.id))
+
+
+@receiver(post_delete)
+def invalidate_on_page_delete(sender, instance, **kwargs):
+    if isinstance(instance, Page):
+        BlogIndexCache.invalidate()
+        block_render_cache.invalidate_references()
+        post_fragments.invalidate_references()
+
+
+@receiver(post_save, sender=PageViewRestriction)
+@receiver(post_delete, sender=PageViewRestriction)
+def invalidate_on_restriction_change(sender, **kwargs):
+    BlogIndexCache.invalidate()
+
+
+@receiver(post_save, sender=get_image_model())
+@receiver(post_delete, sender=get_image_model())
+@receiver(post_delete, sender=get_image_model().get_rendition_model())
+@receiver(post_save, sender=get_document_model())
+@receiver(post_delete, sender=get_document_model())
+def invalidate_on_media_change(sender, **kwargs):
+    block_render_cache.invalidate_references()
+    post_fragments.invalidate_references()
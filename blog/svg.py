@@ -0,0 +1,166 @@
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from urllib.parse import quote
+
+from django.core.files.base import ContentFile
+
+
+logger = logging.getLogger(__name__)
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+# Write SVG elements without a prefix (ElementTree's default_namespace option rejects unprefixed attributes)
+ET.register_namespace('', SVG_NAMESPACE)
+ET.register_namespace('xlink', XLINK_NAMESPACE)
+
+# Namespaces of elements and attributes that only matter to the editors that exported the file
+EDITOR_NAMESPACES = {
+    'http://www.inkscape.org/namespaces/inkscape',
+    'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    'http://www.bohemiancoding.com/sketch/ns',
+    'http://www.serif.com/',
+    'http://ns.adobe.com/AdobeIllustrator/10.0/',
+    'http://ns.adobe.com/Extensibility/1.0/',
+    'http://ns.adobe.com/Graphs/1.0/',
+    'http://ns.adobe.com/SaveForWeb/1.0/',
+    'http://ns.adobe.com/Variables/1.0/',
+    'http://creativecommons.org/ns#',
+    'http://purl.org/dc/elements/1.1/',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+}
+# Elements that don't affect rendering, at least as a background image
+REMOVED_TAGS = {'{%s}%s' % (SVG_NAMESPACE, tag) for tag in ('metadata', 'title', 'desc')}
+TEXT_TAGS = {'{%s}%s' % (SVG_NAMESPACE, tag) for tag in ('text', 'tspan', 'textPath', 'style', 'script')}
+
+PATH_TOKEN_RE = re.compile(r'[MmZzLlHhVvCcSsQqTt]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+POINTS_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+# Characters left as they are in data URIs, which are quoted with single quotes and may end up in <style> elements,
+# where neither HTML entities nor CSS escapes would survive
+DATA_URI_SAFE = " !$()*+,-./:;=?@_~[]{}|^`"
+
+
+def optimize_svg(data, precision=3):
+    """
+    Returns a smaller copy of the given SVG document (as bytes), without
+    comments, metadata and editor-specific markup, and with path data
+    rounded to the given number of decimal places. Documents that can't be
+    parsed are returned as they are.
+    """
+
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        logger.warning("Couldn't parse SVG, so it won't be optimized", exc_info=True)
+        return data
+
+    clean_element(root, precision)
+    return ET.tostring(root, encoding='utf-8', xml_declaration=False).replace(b' />', b'/>')
+
+
+def clean_element(element, precision):
+    for name in list(element.attrib):
+        if get_namespace(name) in EDITOR_NAMESPACES:
+            del element.attrib[name]
+    for name in ('d', 'points'):
+        if name in element.attrib:
+            element.set(name, minify_path(element.get(name), precision) if name == 'd'
+                        else minify_points(element.get(name), precision))
+
+    if element.tag not in TEXT_TAGS:
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        for child in element:
+            if child.tail is not None and not child.tail.strip():
+                child.tail = None
+
+    for child in list(element):
+        if (not isinstance(child.tag, str) or child.tag in REMOVED_TAGS
+                or get_namespace(child.tag) in EDITOR_NAMESPACES):
+            element.remove(child)
+        else:
+            clean_element(child, precision)
+
+
+def get_namespace(name):
+    return name[1:].split('}', 1)[0] if name.startswith('{') else None
+
+
+def format_number(value, precision):
+    number = '{:.{}f}'.format(value, precision).rstrip('0').rstrip('.')
+    if number in ('-0', ''):
+        return '0'
+    if number.startswith('0.'):
+        return number[1:]
+    if number.startswith('-0.'):
+        return '-' + number[2:]
+    return number
+
+
+def join_numbers(tokens):
+    """
+    Joins path tokens with as few separators as possible: none before
+    commands, minus signs, or decimal points following a number that
+    already has one.
+    """
+
+    result = ''
+    previous = None
+    for token in tokens:
+        if previous is not None and not token[0].isalpha() and not previous[0].isalpha():
+            if not (token.startswith('-') or (token.startswith('.') and '.' in previous)):
+                result += ' '
+        result += token
+        previous = token
+    return result
+
+
+def minify_path(d, precision):
+    # Arc flags can be written without separators, which this tokenizer doesn't handle, so leave arcs alone
+    if re.search(r'[Aa]', d):
+        return ' '.join(d.split())
+    tokens = [token if token[0].isalpha() else format_number(float(token), precision)
+              for token in PATH_TOKEN_RE.findall(d)]
+    return join_numbers(tokens)
+
+
+def minify_points(points, precision):
+    return join_numbers([format_number(float(token), precision) for token in POINTS_RE.findall(points)])
+
+
+def svg_data_uri(data):
+    """
+    Returns a data URI for the given SVG document, to be quoted with single
+    quotes. Percent-encoding only what has to be keeps it smaller than
+    base64.
+    """
+
+    return 'data:image/svg+xml,' + quote(data.decode('utf-8'), safe=DATA_URI_SAFE)
+
+
+def get_optimized_name(name):
+    directory, file_name = os.path.split(name)
+    return os.path.join(directory, 'optimized', file_name)
+
+
+def store_optimized_svg(field_file):
+    """
+    Writes an optimized copy of the SVG in the given FileField value next to
+    it (see get_optimized_name()), unless it's already up to date, and
+    returns its content.
+    """
+
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as f:
+        optimized = optimize_svg(f.read())
+
+    optimized_name = get_optimized_name(field_file.name)
+    if storage.exists(optimized_name):
+        with storage.open(optimized_name, 'rb') as f:
+            if f.read() == optimized:
+                return optimized
+        storage.delete(optimized_name)
+    storage.save(optimized_name, ContentFile(optimized))
+    return optimized
@@ -0,0 +1,14 @@
+from django import template
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def post_summary(context, post, full_posts=False):
+    return post.render_summary(context.get('request'), full_posts)
+
+
+@register.simple_tag(takes_context=True)
+def include_stream(context, stream):
+    return stream.stream_block.render_children(stream, context.flatten())
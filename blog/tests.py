@@ -0,0 +1,107 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.templatetags.static import static
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from wagtail.core.models import Site
+
+from .build import BuildManifest, get_view_path
+from .critical_css import CriticalCSS
+from .models import BlogIndex, BlogPost
+from .views import OtherPagesView
+
+
+class IncrementalBuildTests(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.build_dir = os.path.join(temp_dir, 'build')
+        settings_override = override_settings(BUILD_DIR=self.build_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        root = Site.objects.get(is_default_site=True).root_page
+        index = root.add_child(instance=BlogIndex(title='Blog', slug='blog'))
+        now = timezone.now()
+        # The linked post isn't a neighbour of the post linking to it, which would depend on it anyway
+        self.linked_post = self.add_post(index, 'linked', now - timedelta(days=2), [])
+        self.add_post(index, 'between', now - timedelta(days=1), [])
+        self.post = self.add_post(index, 'post', now, [
+            {'type': 'text', 'value': '<p><a linktype="page" id="{}">Linked</a></p>'.format(self.linked_post.id)},
+        ])
+        self.view = OtherPagesView()
+
+    def add_post(self, index, slug, pub_date, body):
+        return index.add_child(instance=BlogPost(title=slug, slug=slug, pub_date=pub_date, body=json.dumps(body)))
+
+    def build_post(self):
+        """
+        Goes through an incremental build of the post, as OtherPagesView
+        would, and returns whether it was built.
+        """
+
+        manifest = BuildManifest(self.build_dir, incremental=True)
+        path, dependencies = self.view.get_task_dependencies((self.post.id, self.post.url), manifest.state)
+        needed = manifest.needs_build(self.view, path, dependencies)
+        if needed:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('built')
+        manifest.finish([get_view_path(OtherPagesView)])
+        return needed
+
+    def test_post_rebuilds_when_linked_page_changes(self):
+        self.assertTrue(self.build_post())
+        self.assertFalse(self.build_post())
+
+        self.linked_post.slug = 'renamed'
+        self.linked_post.save_revision().publish()
+        self.assertTrue(self.build_post())
+        self.assertFalse(self.build_post())
+
+
+class CriticalCSSTests(SimpleTestCase):
+    def setUp(self):
+        self.link = '<link rel="stylesheet" type="text/css" href="{}"/>'.format(static('css/base.css'))
+
+    def process(self, critical_css, body):
+        html = critical_css.process('<html><head>{}</head><body>{}</body></html>'.format(self.link, body))
+        style = re.search(r'<style>(.*?)</style>', html)
+        return html, style and style.group(1)
+
+    def test_only_rules_above_the_fold_are_inlined(self):
+        critical_css = CriticalCSS(fold=100, max_ratio=1)
+        html, style = self.process(critical_css, '<nav id="main_nav"><ul></ul></nav>' + ' ' * 200 +
+                                   '<div class="image_row"></div>')
+        self.assertIn('#main_nav', style)
+        self.assertNotIn('.image_row', style)
+
+    def test_inlined_css_stays_bounded(self):
+        critical_css = CriticalCSS(fold=100000)
+        rules, size = critical_css.stylesheets[static('css/base.css')]
+
+        # A page using every tag, class and ID the stylesheet mentions would inline nearly all of it
+        names = set()
+        stack = list(rules)
+        while stack:
+            rule = stack.pop()
+            stack.extend(rule.children or [])
+            for requirements in rule.selectors or []:
+                names.update(requirements)
+        body = ''.join('<div id="{}"></div>'.format(name[1:]) for name in names if name.startswith('#'))
+        body += '<div class="{}"></div>'.format(' '.join(name[1:] for name in names if name.startswith('.')))
+        body += ''.join('<{0}></{0}>'.format(name) for name in names if name[0] not in '.#')
+
+        for page in ('<nav id="main_nav"><ul></ul></nav>', body):
+            html, style = self.process(critical_css, page)
+            if style is None:
+                self.assertIn(self.link, html)
+            else:
+                self.assertLessEqual(len(style), size * critical_css.max_ratio)
+        self.assertIsNone(style)
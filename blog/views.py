@@ -1,40 +1,87 @@
-from collections import Counter
+import glob
+import itertools
+import logging
 import math
 import os
+from xml.sax.saxutils import escape
 
 from django.conf import settings
-from django.db.models import Count
-from django.db.models.functions import ExtractMonth, ExtractYear
 from django.test import RequestFactory
-from wagtail.core.models import Page
+from wagtail.core.models import Page, Site
 from wagtailbakery.views import WagtailBakeryView
 
-from .models import BlogIndex, BlogPostTag
+from .build import ContentState, ParallelBuildMixin, get_manifest
+from .compression import CompressOutputMixin, compress_output
+from .critical_css import CriticalCSSMixin
+from .minify import MinifyOutputMixin
+from .report import MeasureOutputMixin
+from .writer import WriteBehindMixin, open_atomic
+from .models import BlogIndex
 
 
-class BlogIndexView(WagtailBakeryView):
+logger = logging.getLogger(__name__)
+
+
+class BlogIndexView(MeasureOutputMixin, CriticalCSSMixin, MinifyOutputMixin, CompressOutputMixin, WriteBehindMixin,
+                    ParallelBuildMixin, WagtailBakeryView):
+    def __init__(self, *args, **kwargs):
+        self.blog_indexes = {}
+        super().__init__(*args, **kwargs)
+
     def get_queryset(self):
         return BlogIndex.objects.all().live().public()
 
+    def get_build_tasks(self):
+        for obj in self.get_queryset():
+            for view_name, view_kwargs in self.get_subpages(obj):
+                yield obj.id, view_name, view_kwargs
+
+    def build_task(self, task):
+        page_id, view_name, view_kwargs = task
+        self.build_subpage(self.get_blog_index(page_id), view_name, view_kwargs)
+
+    def get_task_dependencies(self, task, state):
+        page_id, view_name, view_kwargs = task
+        page = self.get_blog_index(page_id)
+
+        posts = state.archive_posts(page_id, view_name, view_kwargs)
+        per_page = page.posts_per_pagination_page
+        offset = (view_kwargs.get('page_num', 1) - 1) * per_page
+
+        dependencies = state.dependencies(page_id, *posts[offset:offset + per_page])
+        dependencies['num_pages'] = math.ceil(len(posts) / per_page)
+        return self.get_subpage_build_path(page, view_name, view_kwargs), dependencies
+
+    def get_blog_index(self, page_id):
+        # Every subpage task needs its index, so only look each one up once per process
+        if page_id not in self.blog_indexes:
+            self.blog_indexes[page_id] = BlogIndex.objects.get(id=page_id)
+        return self.blog_indexes[page_id]
+
     def build_object(self, obj):
-        # Build tag view
-        tag_counts = ((tag, tag.post_count) for tag in BlogPostTag.tag_model().objects
-            .filter(blogpost__in=obj.public_posts())
-            .annotate(post_count=Count('blogpost')))
-        self.paginate_subpage(obj, tag_counts, 'posts_by_tag', lambda tag: {'tag': tag.slug})
-
-        # Build date view
-        # It's possible to get a post count by publication year/month via the ORM, but this
-        # is much more straightforward. For the record, I did get the ORM version working.
-        pub_dates = obj.public_posts().values_list(ExtractYear('pub_date'), ExtractMonth('pub_date'))
-        month_counter = Counter(pub_dates)
-        year_counter = Counter(ym[0] for ym in pub_dates)
-        self.paginate_subpage(obj, month_counter.items(), 'posts_by_date', lambda ym: {'year': ym[0], 'month': ym[1]})
-        self.paginate_subpage(obj, year_counter.items(), 'posts_by_date', lambda year: {'year': year})
-
-        # Build all posts view
-        self.paginate_subpage(obj, ((None, sum(year_counter.values())),), 'all_posts', lambda _: {},
-                              always_build_first_page=True)
+        for view_name, view_kwargs in self.get_subpages(obj):
+            self.build_subpage(obj, view_name, view_kwargs)
+
+    def get_subpages(self, obj):
+        """
+        Yields the view name and kwargs of each routable subpage of the given
+        index, including every pagination page.
+        """
+
+        counts = obj.archive_counts()
+
+        # Tag view
+        tag_counts = ((counts.tag_slugs[tag], count) for tag, count in counts.tags.items())
+        yield from self.paginate_subpage(obj, tag_counts, 'posts_by_tag', lambda slug: {'tag': slug})
+
+        # Date view
+        yield from self.paginate_subpage(obj, counts.months.items(), 'posts_by_date',
+                                         lambda ym: {'year': ym[0], 'month': ym[1]})
+        yield from self.paginate_subpage(obj, counts.years.items(), 'posts_by_date', lambda year: {'year': year})
+
+        # All posts view
+        yield from self.paginate_subpage(obj, ((None, counts.total),), 'all_posts', lambda _: {},
+                                         always_build_first_page=True)
 
     def paginate_subpage(self, page, counts, view_name, view_kwargs_func, always_build_first_page=False):
         for key, count in counts:
@@ -42,9 +89,9 @@ class BlogIndexView(WagtailBakeryView):
             for page_num in range(1, math.ceil(count / page.posts_per_pagination_page) + 1):
                 if page_num > 1:
                     view_kwargs['page_num'] = page_num
-                self.build_subpage(page, view_name, view_kwargs)
+                yield view_name, dict(view_kwargs)
             if count == 0 and always_build_first_page:
-                self.build_subpage(page, view_name, view_kwargs)
+                yield view_name, dict(view_kwargs)
 
     def build_subpage(self, page, view_name, view_kwargs):
         hostname = page.get_site().hostname
@@ -53,14 +100,154 @@ class BlogIndexView(WagtailBakeryView):
         self.request = RequestFactory(SERVER_NAME=hostname).get(url)
         content = self.get_content(page)
 
-        path = os.path.join(settings.BUILD_DIR, url[1:])
-        if not os.path.exists(path):
-            os.makedirs(path)
-        path = os.path.join(path, 'index.html')
+        self.build_file(self.get_subpage_build_path(page, view_name, view_kwargs), content)
 
-        self.build_file(path, content)
+    def get_subpage_build_path(self, page, view_name, view_kwargs):
+        url = page.url + page.reverse_subpage(view_name, kwargs=view_kwargs)
+        return os.path.join(settings.BUILD_DIR, url[1:], 'index.html')
 
 
-class OtherPagesView(WagtailBakeryView):
+class OtherPagesView(MeasureOutputMixin, CriticalCSSMixin, MinifyOutputMixin, CompressOutputMixin, WriteBehindMixin,
+                     ParallelBuildMixin, WagtailBakeryView):
     def get_queryset(self):
         return Page.objects.all().live().public().not_type(BlogIndex)
+
+    def get_build_tasks(self):
+        for item in self.get_queryset().specific():
+            url = self.get_url(item)
+            if url is not None:
+                yield item.id, url
+
+    def build_task(self, task):
+        page_id, url = task
+        self.build_object(Page.objects.get(id=page_id))
+
+    def get_task_dependencies(self, task, state):
+        page_id, url = task
+        page_ids = [page_id]
+
+        # Posts also show links to their neighbours and their index
+        if page_id in state.post_indexes:
+            page_ids.extend(state.neighbours(page_id))
+            page_ids.append(state.post_indexes[page_id])
+
+        return os.path.join(settings.BUILD_DIR, url[1:], 'index.html'), state.dependencies(*page_ids)
+
+    def get_build_path(self, obj):
+        # Unlike WagtailBakeryView's, this leaves creating the directory to the output writer
+        return os.path.join(settings.BUILD_DIR, self.get_url(obj)[1:], 'index.html')
+
+
+class SitemapView(object):
+    """
+    Builds sitemap.xml, listing every page built by OtherPagesView and every
+    route built by BlogIndexView, with the time their content was last
+    published. Entries are written out as they're enumerated. Past
+    max_urls, they're split across sitemap-N.xml files, and sitemap.xml
+    becomes a sitemap index pointing at them.
+    """
+
+    build_path = 'sitemap.xml'
+    max_urls = 50000
+
+    @property
+    def build_method(self):
+        return self.build
+
+    def build(self):
+        manifest = get_manifest()
+        state = manifest.state if manifest is not None else ContentState()
+
+        entries = self.get_entries(state)
+        count = urls = 0
+        entry = next(entries, None)
+        while entry is not None:
+            count += 1
+            urls += self.write_urlset(self.get_part_path(count), itertools.chain([entry], entries))
+            entry = next(entries, None)
+
+        path = os.path.join(settings.BUILD_DIR, self.build_path)
+        if count > 1:
+            self.write_index(path, count)
+            parts = [self.get_part_path(number) for number in range(1, count + 1)]
+        else:
+            if count == 1:
+                os.replace(self.get_part_path(1), path)
+            else:
+                self.write_urlset(path, iter(()))
+            parts = []
+        self.remove_stale_parts(parts)
+
+        for part_path in parts + [path]:
+            compress_output(part_path)
+        logger.info('Sitemap: %d URLs in %d files', urls, len(parts) + 1)
+
+    def get_entries(self, state):
+        """
+        Yields the absolute URL and last publication time (or None) of every
+        built page.
+        """
+
+        index_view = BlogIndexView()
+        for index in index_view.get_queryset():
+            root_url = index.full_url
+            for view_name, view_kwargs in index_view.get_subpages(index):
+                # Listings change with the posts they show, as in BlogIndexView.get_task_dependencies()
+                posts = state.archive_posts(index.id, view_name, view_kwargs)
+                per_page = index.posts_per_pagination_page
+                offset = (view_kwargs.get('page_num', 1) - 1) * per_page
+                yield (root_url + index.reverse_subpage(view_name, kwargs=view_kwargs),
+                       self.get_lastmod(state, index.id, *posts[offset:offset + per_page]))
+
+        for page in OtherPagesView().get_queryset().iterator():
+            url = page.full_url
+            if url is not None:
+                yield url, self.get_lastmod(state, page.id)
+
+    def get_lastmod(self, state, *page_ids):
+        # Times are stored as ISO 8601, so they sort chronologically
+        return max((state.last_published[page_id] for page_id in page_ids if state.last_published.get(page_id)),
+                   default=None)
+
+    def get_part_path(self, number):
+        name, extension = os.path.splitext(self.build_path)
+        return os.path.join(settings.BUILD_DIR, '{}-{}{}'.format(name, number, extension))
+
+    def write_urlset(self, path, entries):
+        """
+        Writes up to max_urls entries from the given iterator to a sitemap and
+        returns how many were written.
+        """
+
+        urls = 0
+        with open_atomic(path) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                    b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for url, lastmod in itertools.islice(entries, self.max_urls):
+                f.write('<url><loc>{}</loc>{}</url>\n'.format(
+                    escape(url), '<lastmod>{}</lastmod>'.format(lastmod) if lastmod else '').encode())
+                urls += 1
+            f.write(b'</urlset>\n')
+        return urls
+
+    def write_index(self, path, count):
+        root_url = Site.objects.get(is_default_site=True).root_url
+        with open_atomic(path) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                    b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for number in range(1, count + 1):
+                url = '{}/{}'.format(root_url, os.path.relpath(self.get_part_path(number), settings.BUILD_DIR))
+                f.write('<sitemap><loc>{}</loc></sitemap>\n'.format(escape(url)).encode())
+            f.write(b'</sitemapindex>\n')
+
+    def remove_stale_parts(self, parts):
+        """
+        Removes parts left by a previous build of a bigger sitemap, along with
+        their precompressed siblings.
+        """
+
+        name, extension = os.path.splitext(self.build_path)
+        pattern = os.path.join(settings.BUILD_DIR, '{}-*{}'.format(name, extension))
+        for path in glob.glob(pattern) + glob.glob(pattern + '.gz') + glob.glob(pattern + '.br'):
+            if os.path.splitext(path)[0] not in parts and path not in parts:
+                os.remove(path)
@@ -0,0 +1,164 @@
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# The writer of the build in progress, if any
+_writer = None
+
+# Files are created with mkstemp's private mode, so apply the usual permissions before renaming them into place
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@contextlib.contextmanager
+def open_atomic(path):
+    """
+    Opens a temporary file next to the given path for writing in binary mode,
+    then renames it into place once the block exits without an error, so
+    that the file is never seen half written.
+    """
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}.'.format(os.path.basename(path)),
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.chmod(temp_path, 0o666 & ~_umask)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_file_atomic(path, data):
+    if isinstance(data, str):
+        data = data.encode()
+    with open_atomic(path) as f:
+        f.write(data)
+
+
+class OutputWriter(object):
+    """
+    Writes built files in a pool of threads, so that rendering doesn't wait
+    on the filesystem. At most settings.BUILD_WRITE_QUEUE_SIZE files are held
+    in memory at once; beyond that, submitting a file waits for a thread to
+    catch up. Directories are created once per build, ideally in a batch
+    ahead of time (see make_dirs()), rather than checked for every file.
+
+    Worker processes can't reach the parent's threads, so they write their
+    files straight away with write_file_atomic(). Other workers keep
+    rendering meanwhile, and the parent compresses each file as soon as
+    the task that built it is done, so it has to be on disk by then.
+    """
+
+    def __init__(self, threads=4, max_pending=None):
+        if max_pending is None:
+            max_pending = settings.BUILD_WRITE_QUEUE_SIZE
+
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.written = 0
+        self.errors = []
+
+    def make_dirs(self, paths):
+        """
+        Creates the directories of all the given file paths that haven't
+        been created yet.
+        """
+
+        dir_paths = {os.path.dirname(path) for path in paths} - self.dirs
+        for dir_path in sorted(dir_paths):
+            os.makedirs(dir_path, exist_ok=True)
+
+        with self.lock:
+            for dir_path in dir_paths:
+                # Parents exist too, so there's no need to check them later either
+                while dir_path not in self.dirs and dir_path != os.path.dirname(dir_path):
+                    self.dirs.add(dir_path)
+                    dir_path = os.path.dirname(dir_path)
+
+    def submit(self, path, data):
+        self.pending.acquire()
+        try:
+            future = self.executor.submit(self.write, path, data)
+        except BaseException:
+            self.pending.release()
+            raise
+        future.add_done_callback(self.done)
+
+    def write(self, path, data):
+        if os.path.dirname(path) not in self.dirs:
+            self.make_dirs([path])
+        write_file_atomic(path, data)
+
+    def done(self, future):
+        self.pending.release()
+        with self.lock:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            else:
+                self.written += 1
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+
+    def finish(self):
+        """
+        Waits for outstanding files, then raises the first error encountered,
+        if any.
+        """
+
+        self.wait()
+        logger.info('Wrote %d files in the background', self.written)
+
+        if self.errors:
+            logger.error('%d files failed to write', len(self.errors))
+            raise self.errors[0]
+
+
+def get_writer():
+    return _writer
+
+
+def set_writer(writer):
+    global _writer
+    _writer = writer
+
+
+def write_output(path, data):
+    """
+    Writes a built file, in the background if a build with a writer is in
+    progress in this process.
+    """
+
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.submit(path, data)
+    else:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, data)
+
+
+class WriteBehindMixin(object):
+    """
+    Mixin for bakery views that writes the files they build with
+    write_output(). Files that bakery would gzip in place are left to it.
+    """
+
+    def build_file(self, path, html):
+        if self.is_gzippable(path):
+            super().build_file(path, html)
+        else:
+            write_output(path, html)
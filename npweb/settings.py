@@ -94,6 +94,47 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'highlight': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'highlight'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Holds the tokens that invalidate in-process caches, so it has to be shared by all processes
+    'invalidation': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'invalidation'),
+        'TIMEOUT': None,
+    },
+    'blocks': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'blocks',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+    # Used by Wagtail to look up renditions, several of which are shown for each image
+    'renditions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'renditions',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -129,6 +170,9 @@ STATICFILES_DIRS = [
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATIC_URL = '/static/'
 
+# Fingerprint static file names so they can be cached forever (run collectstatic to update the manifest)
+STATICFILES_STORAGE = 'npweb.storage.ManifestStaticFilesStorage'
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
@@ -152,9 +196,66 @@ BAKERY_VIEWS = (
     'blog.views.BlogIndexView',
     'blog.views.OtherPagesView',
     'blog.models.BlogPostFeed',
+    'blog.views.SitemapView',
+    'blog.search.SearchIndexView',
 )
 
+# Number of processes to build pages with, overridden by "manage.py build --workers"
+BUILD_WORKERS = 1
+
+# Built files that get precompressed .gz (and .br) siblings, if they're at least BUILD_COMPRESSION_MIN_SIZE bytes
+BUILD_COMPRESSED_EXTENSIONS = ['.html', '.xml', '.css', '.svg', '.json']
+BUILD_COMPRESSION_MIN_SIZE = 1024
+
+# Maximum number of built files waiting to be written in the background
+BUILD_WRITE_QUEUE_SIZE = 64
+
+# Whether to rebuild the files affected by pages published or unpublished in the admin, once no further changes
+# have been made for LIVE_REBUILD_DELAY seconds. Needs a previous "manage.py build" to update.
+LIVE_REBUILD = False
+LIVE_REBUILD_DELAY = 5
+
+# Stylesheets whose critical rules are inlined into built pages by "manage.py build --critical-css"
+BUILD_CRITICAL_CSS = ['css/base.css']
+# Only the rules for what's in this many characters from the start of the body are inlined, and only if they come to
+# at most this fraction of their stylesheet, as the full stylesheet still loads afterwards
+BUILD_CRITICAL_CSS_FOLD = 2000
+BUILD_CRITICAL_CSS_MAX_RATIO = 0.3
+
+# Hero SVGs are optimized on upload and before builds; those no larger than this many bytes afterwards are inlined
+# into pages as data URIs rather than linked to
+HERO_SVG_INLINE_MAX_SIZE = 4096
+
+
+# Logging
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'blog': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 
 # Project-specific settings
 
+# Django cache that keeps syntax highlighted code blocks between builds, or None to only cache in memory
+HIGHLIGHT_CACHE = 'highlight'
+
+# Django cache shared by all processes (e.g. server workers and the build) through which changes to posts invalidate
+# the data each of them caches in memory
+INVALIDATION_CACHE = 'invalidation'
+
+# Django cache that keeps rendered stream blocks between requests, e.g. 'blocks', or None to render them every time
+BLOCK_RENDER_CACHE = None
+
 GOOGLE_ANALYTICS_ID = os.environ.get('GOOGLE_ANALYTICS_ID')
@@ -0,0 +1,202 @@
+/* Searches the static index written by blog.search.SearchIndexView. Nothing
+   is fetched until the search field is first used: then index.json is, and
+   shards of the index as queries need them. The form is hidden without
+   JavaScript, as it only works with it. */
+
+(function () {
+    'use strict';
+
+    var WORD_RE = /[\p{L}\p{N}_]+/gu;
+    var MARK_RE = /\p{M}/gu;
+    var MAX_RESULTS = 10;
+
+    function SearchIndex(root) {
+        this.root = root;
+        this.loaded = null;
+        this.meta = null;
+        this.docs = null;
+        this.shards = {};
+    }
+
+    SearchIndex.prototype.fetchJSON = function (name, hash) {
+        return fetch(this.root + name + '?v=' + hash).then(function (response) {
+            if (!response.ok) {
+                throw new Error('Failed to load ' + name + ': ' + response.status);
+            }
+            return response.json();
+        });
+    };
+
+    // Resolves once index.json has been loaded, fetching it on the first call (or the first after a failure)
+    SearchIndex.prototype.load = function () {
+        var self = this;
+        if (this.loaded === null) {
+            this.loaded = fetch(this.root + 'index.json', {cache: 'no-cache'}).then(function (response) {
+                if (!response.ok) {
+                    throw new Error('Failed to load the search index: ' + response.status);
+                }
+                return response.json();
+            }).then(function (meta) {
+                self.meta = meta;
+                self.stopWords = new Set(meta.stop_words);
+            }, function (error) {
+                self.loaded = null;
+                throw error;
+            });
+        }
+        return this.loaded;
+    };
+
+    // The same as blog.search.tokenize()
+    SearchIndex.prototype.tokenize = function (text) {
+        var self = this;
+        var words = text.toLowerCase().normalize('NFKD').replace(MARK_RE, '').match(WORD_RE) || [];
+        return words.filter(function (word) {
+            // Counted in code points, as in Python, rather than UTF-16 code units
+            return Array.from(word).length >= self.meta.prefix_length && !self.stopWords.has(word);
+        });
+    };
+
+    SearchIndex.prototype.shardKey = function (term) {
+        return Array.from(term).slice(0, this.meta.prefix_length).join('').replace(/[^a-z0-9]/gu, '_');
+    };
+
+    SearchIndex.prototype.getShard = function (key) {
+        if (!(key in this.meta.shards)) {
+            return Promise.resolve({});
+        }
+        if (!(key in this.shards)) {
+            this.shards[key] = this.fetchJSON(key + '.json', this.meta.shards[key]);
+        }
+        return this.shards[key];
+    };
+
+    SearchIndex.prototype.getDocs = function () {
+        if (this.docs === null) {
+            this.docs = this.fetchJSON('docs.json', this.meta.docs).then(function (docs) {
+                var byId = new Map();
+                docs.forEach(function (doc, position) {
+                    byId.set(doc[0], {url: doc[1], title: doc[2], date: doc[3], position: position});
+                });
+                return byId;
+            });
+        }
+        return this.docs;
+    };
+
+    /* Resolves to the posts matching every word of the query, each as a
+       prefix of a term, best first. */
+    SearchIndex.prototype.search = function (query) {
+        var self = this;
+        return this.load().then(function () {
+            var words = Array.from(new Set(self.tokenize(query)));
+            if (!words.length) {
+                return [];
+            }
+
+            return Promise.all(words.map(function (word) {
+                return self.getShard(self.shardKey(word));
+            }).concat([self.getDocs()])).then(function (results) {
+                var docs = results.pop();
+                var scores = null;
+
+                words.forEach(function (word, i) {
+                    var wordScores = new Map();
+                    Object.keys(results[i]).forEach(function (term) {
+                        if (term.startsWith(word)) {
+                            results[i][term].forEach(function (posting) {
+                                wordScores.set(posting[0], Math.max(wordScores.get(posting[0]) || 0, posting[1]));
+                            });
+                        }
+                    });
+
+                    if (scores === null) {
+                        scores = wordScores;
+                    } else {
+                        scores.forEach(function (score, id) {
+                            if (wordScores.has(id)) {
+                                scores.set(id, score + wordScores.get(id));
+                            } else {
+                                scores.delete(id);
+                            }
+                        });
+                    }
+                });
+
+                return Array.from(scores.keys()).filter(function (id) {
+                    return docs.has(id);
+                }).sort(function (a, b) {
+                    return scores.get(b) - scores.get(a) || docs.get(a).position - docs.get(b).position;
+                }).map(function (id) {
+                    return docs.get(id);
+                });
+            });
+        });
+    };
+
+    function showResults(list, results, query) {
+        list.textContent = '';
+        results.slice(0, MAX_RESULTS).forEach(function (doc) {
+            var item = document.createElement('li');
+            var link = document.createElement('a');
+            link.href = doc.url;
+            link.className = 'blocklink';
+            link.textContent = doc.title;
+            var date = document.createElement('span');
+            date.className = 'faded';
+            date.textContent = ' ' + doc.date;
+            link.appendChild(date);
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+        if (!results.length && query) {
+            var item = document.createElement('li');
+            item.className = 'faded';
+            item.textContent = 'No posts found.';
+            list.appendChild(item);
+        }
+        list.hidden = !query;
+    }
+
+    function init() {
+        var form = document.getElementById('site_search');
+        var list = document.getElementById('search_results');
+        if (!form || !list || !window.fetch) {
+            return;
+        }
+
+        var index = new SearchIndex(form.getAttribute('data-index'));
+        var input = form.querySelector('input');
+        var latest = 0;
+
+        form.hidden = false;
+        // Starts loading the index while the first query is being typed
+        input.addEventListener('focus', function () {
+            index.load().catch(function () {});
+        }, {once: true});
+
+        form.addEventListener('submit', function (event) {
+            event.preventDefault();
+        });
+        input.addEventListener('input', function () {
+            var query = input.value.trim();
+            var current = ++latest;
+            index.search(query).then(function (results) {
+                // Ignore results that arrive after those of a later query
+                if (current === latest) {
+                    showResults(list, results, query);
+                }
+            }, function () {
+                if (current === latest) {
+                    showResults(list, [], query);
+                }
+            });
+        });
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', init);
+    } else {
+        init();
+    }
+}());
@@ -0,0 +1,32 @@
+import logging
+
+from django.contrib.staticfiles import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+class ManifestStaticFilesStorage(storage.ManifestStaticFilesStorage):
+    """
+    Stores static files under names that include a hash of their content, as
+    listed in a manifest written by collectstatic, so that both the live site
+    and built pages link to URLs that can be cached forever.
+
+    Some referenced files aren't checked in (e.g. MathJax and the fonts), so
+    rather than failing, missing files keep their unhashed names.
+    """
+
+    manifest_strict = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.missing = set()
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            if name not in self.missing:
+                self.missing.add(name)
+                logger.warning("Static file %s doesn't exist, so its URL won't be fingerprinted", name)
+            return name
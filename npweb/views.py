@@ -1,9 +1,33 @@
+import os
+
 from bakery.views import Buildable404View
+from django.conf import settings
 from django.core.handlers.base import BaseHandler
 
+from blog.build import get_manifest
+from blog.compression import CompressOutputMixin
+from blog.critical_css import CriticalCSSMixin
+from blog.minify import MinifyOutputMixin
+from blog.report import MeasureOutputMixin
+from blog.writer import WriteBehindMixin
+
+
+class ResponseContentMixin(object):
+    # Middleware may respond with something other than a TemplateResponse. This sits below the output mixins, so
+    # that their get_content() methods still apply.
+    def get_content(self):
+        response = self.get(self.request)
+        if hasattr(response, 'render'):
+            return response.render().content
+        if hasattr(response, 'content'):
+            return response.content
+        raise AttributeError(
+            "'%s' object has no attribute 'render' or 'content'" % response)
+
 
 # Our 404 template depends on middleware, which Buildable404View doesn't consult before rendering
-class Middleware404View(Buildable404View):
+class Middleware404View(MeasureOutputMixin, CriticalCSSMixin, MinifyOutputMixin, CompressOutputMixin, WriteBehindMixin,
+                        ResponseContentMixin, Buildable404View):
     build_path = 'err-404.html'
 
     def __init__(self, **kwargs):
@@ -11,14 +35,11 @@ class Middleware404View(Buildable404View):
         self.handler.load_middleware()
         super().__init__(**kwargs)
 
+    def build(self):
+        manifest = get_manifest()
+        path = os.path.join(settings.BUILD_DIR, self.get_build_path())
+        if manifest is None or manifest.needs_build(self, path, manifest.state.dependencies()):
+            super().build()
+
     def get(self, request):
         return self.handler.get_response(request)
-
-    def get_content(self):
-        response = self.get(self.request)
-        if hasattr(response, 'render'):
-            return response.render().content
-        if hasattr(response, 'content'):
-            return response.content
-        raise AttributeError(
-            "'%s' object has no attribute 'render' or 'content'" % response)